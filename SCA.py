@@ -2,7 +2,7 @@
 # (August 2010). You can obtain the latest version of this program
 # from http://gesc19764.pwp.blueyonder.co.uk/sca.html
 
-import traceback, yaml
+import hashlib, os, random, traceback
 
 from SCArule import *
 
@@ -222,8 +222,12 @@ class SCA():
         # Files we're currently including.
         self.files = set([])
 
+        # What getCat() has made of each category expression; cleared
+        # whenever anything is defined.
+        self.cats = {}
+
         # Parameters for directives.
-        self.dirparams = yaml.load(file("SCAdirparams.yaml", "r"))
+        self.dirparams = loadYAML("SCAdirparams.yaml")
 
         # Exceptions, amazingly.
         self.exceptions = SCAExceptionWords()
@@ -234,6 +238,37 @@ class SCA():
         # If this is not None, "random" numbers will be seeded with it.
         self.lastword = None
 
+        # The source of random numbers when they aren't seeded by word,
+        # which is these rules' own; see getRandom(). _seed_ is the
+        # last value given to dir_seed(), if any.
+        self.rng, self.seed = random.Random(), None
+
+        # The sources of random numbers for groups for the last word;
+        # see getRandom().
+        self.streams = {}
+
+        # Every file which rules or exceptions have been read from; see
+        # SCAcompiled.py.
+        self.sources = []
+
+        # What had been compiled when each heading or group was added
+        # to the main group, and when each persistent rule was; see
+        # mark() and SCAwatch.py.
+        self.marks = []
+
+        # A digest of everything which has been compiled, and of the
+        # things which affect how it was compiled; see getSignature().
+        self.digest = hashlib.sha1()
+        self.digest.update(repr((enc, sorted(defs.items()))))
+
+        # The SCACache for process(), if any, and whether results can
+        # be cached at all; see isCacheable().
+        self.cache, self.cacheable = None, None
+
+        # Whether persistent rules can be skipped for words they've
+        # left unchanged; see canSkipPersistent().
+        self.skippable = None
+
     ######################################################################
 
     """ Return the SCADefinition corresponding to _deftype_, or
@@ -250,6 +285,7 @@ class SCA():
     """
     def addDef(self, deftype, name, value):
         self.getDefinition(deftype).put(name, value)
+        self.cats.clear()
 
     """ Is _name_ defined in _deftype_? """
     def hasDef(self, deftype, name):
@@ -291,20 +327,24 @@ class SCA():
     '^A' or '-A'    [^abcde]
     """
     def getCat(self, cat):
+        if cat not in self.cats: self.cats[cat] = self.makeCat(cat)
+
+        return self.cats[cat]
+
+    """ Work out what getCat() returns for _cat_. """
+    def makeCat(self, cat):
         L = re.split("([-+^])", cat)
 
         if len(L) == 0: return ""
 
         chars, add, first, comp = [], True, True, False
 
-        while len(L) > 0:
-            s = L.pop(0)
-
+        for i, s in enumerate(L):
             if s == '': continue
             if s == '^' and first: comp, first = True, False; continue
             if s == '+': add, first = True,  False; continue
             if s == '-':
-                if first and len(L) == 1: return "^" + L[0]
+                if first and i == len(L) - 2: return "^" + L[-1]
                 add, first = False, False
                 continue
 
@@ -317,7 +357,9 @@ class SCA():
                     t = s
 
             if add: chars += t
-            else:   chars = [ c for c in chars if c not in t ]
+            else:
+                T = set(t)
+                chars = [ c for c in chars if c not in T ]
 
             first = False
 
@@ -419,9 +461,11 @@ class SCA():
 
     """ Set the seed to _s_. """
     def dir_seed(self, s):
-        if   s == 'time': random.seed()
+        self.seed = s
+
+        if   s == 'time': self.rng.seed()
         elif s == 'word': self.lastword = ''
-        else:             random.seed(s)
+        else:             self.rng.seed(s)
 
     """ Set the dialect prefix, which is prepended to each subsequent
     line, to _s_. _s_ should be empty to turn this off.
@@ -435,7 +479,11 @@ class SCA():
 
     """ Define a new group with parameters _P_. """
     def dir_group(self, P):
-        self.activegroup = self.activegroup.addGroup(self, P, self.cldefs)
+        G = self.activegroup.addGroup(self, P, self.cldefs)
+
+        if self.activegroup is self.main: self.mark(G)
+
+        self.activegroup = G
 
     """ End the definition of the current group.
     _P_: ignored, but needed for consistency
@@ -448,9 +496,16 @@ class SCA():
 
     """ Add a heading with text in _s_. """
 
-    def dir_heading(      self, s): self.activegroup.addHeading(0, s)
-    def dir_subheading(   self, s): self.activegroup.addHeading(1, s)
-    def dir_subsubheading(self, s): self.activegroup.addHeading(2, s)
+    def dir_heading(      self, s): self.addHeading(0, s)
+    def dir_subheading(   self, s): self.addHeading(1, s)
+    def dir_subsubheading(self, s): self.addHeading(2, s)
+
+    """ Add a heading at _level_ with text in _s_ to the active group.
+    """
+    def addHeading(self, level, s):
+        H = self.activegroup.addHeading(level, s)
+
+        if self.activegroup is self.main: self.mark(H)
 
     """ Add an assertion. The arguments must be, in order, the
     dialect, the word, and the expected result.
@@ -464,8 +519,7 @@ class SCA():
     def dir_exception(self, *args): self.exceptions.add(*args)
 
     """ Read in exceptions from _s_. """
-    def dir_exceptfile(self, s):
-        self.exceptions.readFromFile(s, self.enc)
+    def dir_exceptfile(self, s): self.loadExceptions(s)
 
     """ We want to skip subsequent lines. """
     def dir_skip(self, *args): self.skip = True
@@ -492,6 +546,12 @@ class SCA():
     hand.
     """
     def compile(self, f, n, s):
+        if isinstance(s, unicode): self.digest.update(s.encode("utf-8"))
+        else:                      self.digest.update(s)
+
+        self.digest.update("\n")
+        self.cacheable, self.skippable = None, None
+
         if self.skip and s not in "!noskip" and s not in "!end":
             return
 
@@ -521,6 +581,7 @@ class SCA():
 
         if R.persistent:
             self.persistent.addRule(R)
+            self.mark(R)
             self.prules += 1
         else:
             self.activegroup.addRule(R)
@@ -528,6 +589,13 @@ class SCA():
 
         self.lastrule = R
 
+    """ Note that _item_ has just been compiled, with a digest of
+    everything compiled so far. If two sets of rules have the same
+    digest for an item, everything before it is the same in both.
+    """
+    def mark(self, item):
+        self.marks.append((item, self.digest.hexdigest()))
+
     """ Read rules, definitions, and so on from a file.
     f: the name of the file
     enc: its encoding
@@ -542,6 +610,7 @@ class SCA():
             raise SCAException("File is already being included")
 
         self.files.add(f)
+        self.sources.append(os.path.abspath(f))
 
         for s, n in readfile(f, self.enc):
             try:
@@ -554,6 +623,13 @@ class SCA():
         self.done, self.skip = False, False
         self.files.remove(f)
 
+    """ Read in exceptions from file _f_; see
+    SCAExceptionWords.readFromFile().
+    """
+    def loadExceptions(self, f):
+        self.sources.append(os.path.abspath(f))
+        self.exceptions.readFromFile(f, self.enc)
+
     ######################################################################
 
     """ Process _word_ through all the rules, in _dialects_.
@@ -562,16 +638,167 @@ class SCA():
     def process(self, word, dialects = None, **extras):
         if dialects is None: dialects = self.dialects
 
+        key = None
+
+        # Tracing and assertions need the rules to be run.
+        if self.cache is not None and extras.get("func") is None and \
+           not extras.get("doassert") and self.isCacheable():
+            key = self.cache.makeKey(self.getSignature(), word,
+                                     "".join(dialects))
+            H = self.cache.get(key)
+
+            if H is not None: return H
+
         H = { }
 
         self.setLastWord(word)
+        self.persistent.fixed.clear()
 
         for d in dialects: H[d] = word
 
         self.main.process(H, self.exceptions, self.persistent, **extras)
 
+        if key is not None: self.cache.put(key, H)
+
         return H
 
+    """ Process each of _words_ through all the rules, in _dialects_,
+    as process() would, _size_ words at a time. Each rule is applied
+    to every word in a batch before the next rule, so that less time
+    is spent going from one rule to the next; this can only be done if
+    the results can be cached (see isCacheable()), and otherwise the
+    words are processed one by one. A word which comes up more than
+    once in a batch is only processed once, and most rules are applied
+    to all the words in a batch in one search; see
+    SCARule.applyJoined().
+
+    The return value is an iterator which yields a tuple of results
+    for each word, one for each dialect, or, if _columns_ is True, a
+    dictionary which maps each dialect to a list of results, one for
+    each word.
+    """
+    def process_many(self, words, dialects = None, columns = False,
+                     size = 1000):
+        if dialects is None: dialects = self.dialects
+
+        T = self.processBatches(words, dialects, size)
+
+        if not columns: return T
+
+        C = dict([ (d, []) for d in dialects ])
+
+        for t in T:
+            for d, w in zip(dialects, t): C[d].append(w)
+
+        return C
+
+    """ Yield what process_many() does for _words_, in batches of _size_.
+    """
+    def processBatches(self, words, dialects, size):
+        for L in chunks(words, size):
+            for t in self.processBatch(L, dialects): yield t
+
+    """ Return a list of tuples of results for each of _words_, one for
+    each of _dialects_, from processing them all at once.
+    """
+    def processBatch(self, words, dialects):
+        if not self.isCacheable():
+            return [ tuple([ H[d] for d in dialects ])
+                     for H in [ self.process(w, dialects) for w in words ] ]
+
+        R, L, keys = {}, {}, {}
+
+        for word in words:
+            if word in R or word in L: continue
+
+            if self.cache is not None:
+                key = self.cache.makeKey(self.getSignature(), word,
+                                         "".join(dialects))
+                H = self.cache.get(key)
+
+                if H is not None:
+                    R[word] = tuple([ H[d] for d in dialects ])
+                    continue
+
+                keys[word] = key
+
+            L[word] = SCAWord(self, word, dialects)
+
+        if len(L) > 0:
+            self.main.processMany(L.values(), self.exceptions,
+                                  self.persistent)
+            self.persistent.fixed = {}
+
+        for word, W in L.items():
+            R[word] = tuple([ W.H[d] for d in dialects ])
+
+            if word in keys: self.cache.put(keys[word], W.H)
+
+        return [ R[word] for word in words ]
+
+    """ Return a signature of the rules, definitions, and exceptions,
+    and of the command-line variables and encoding they were read
+    with, which changes if any of them do.
+    """
+    def getSignature(self):
+        return self.digest.hexdigest() + self.exceptions.digest.hexdigest()
+
+    """ Do any rules or groups use random numbers? """
+    def isRandom(self):
+        return self.main.isRandom() or self.persistent.isRandom()
+
+    """ Can the results of process() be cached? Not if groups change
+    as they're used, and not if they use random numbers which aren't
+    seeded with the word.
+    """
+    def isCacheable(self):
+        if self.cacheable is None:
+            G = self.main, self.persistent
+
+            self.cacheable = not G[0].changesParams() and \
+                             not G[1].changesParams() and \
+                             (self.lastword is not None or
+                              not self.isRandom())
+
+        return self.cacheable
+
+    """ Can the persistent rules be skipped for a word which they've
+    already left unchanged? Only if they always do the same thing to
+    the same word, which they don't if they use random numbers which
+    aren't seeded by the word, or if their group uses any at all.
+    """
+    def canSkipPersistent(self):
+        if self.skippable is None:
+            P = self.persistent
+
+            self.skippable = not P.hasRandomParams() and \
+                             (self.lastword is not None or not P.isRandom())
+
+        return self.skippable
+
+    """ Cache the results of process() from now on, keeping _size_ of
+    them in memory and, if _filename_ is not None, all of them in that
+    file too; see SCAcache.py. Nothing is cached for rules which can't
+    be; see isCacheable().
+    """
+    def setCache(self, size = 10000, filename = None):
+        import SCAcache
+        self.closeCache()
+        self.cache = SCAcache.SCACache(size, filename)
+
+    """ Stop caching, and write any cache file. """
+    def closeCache(self):
+        if self.cache is not None: self.cache.close()
+        self.cache = None
+
+    """ Replace rules with faster equivalents where possible; see
+    SCAopt.py. This must be done after all the rules and exceptions
+    have been read.
+    """
+    def optimise(self):
+        import SCAopt
+        SCAopt.optimiseGroup(self, self.main)
+
     """ Show all rules; for debugging. """
     def showRules(self): self.main.showRules(self.enc)
 
@@ -604,7 +831,28 @@ class SCA():
     def setLastWord(self, word):
         if self.lastword is None: return
 
-        self.lastword = word
-        random.seed(self.lastword)
+        self.lastword, self.streams = word, {}
+
+    """ Return the source of random numbers for the rule or group
+    identified by _key_. Unless they're seeded by word, this is just
+    the one which these rules share, so that other rules in the same
+    program don't change their numbers. Otherwise it's seeded with _key_ and _word_,
+    or, if _word_ is None, with the last word, in which case the
+    same one is returned until the next word.
+    """
+    def getRandom(self, key, word = None):
+        if self.lastword is None: return self.rng
+
+        if word is None:
+            if key not in self.streams:
+                self.streams[key] = self.getRandom(key, self.lastword)
+
+            return self.streams[key]
+
+        if isinstance(word, unicode): word = word.encode("utf-8")
+
+        D = hashlib.md5(repr(key) + "\0" + word)
+
+        return random.Random(int(D.hexdigest(), 16))
 
 ##############################################################################
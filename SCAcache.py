@@ -0,0 +1,92 @@
+# This file is part of Geoff's Sound Change Applier, version 0.8
+# (August 2010). You can obtain the latest version of this program
+# from http://gesc19764.pwp.blueyonder.co.uk/sca.html
+
+""" A cache of the results of SCA.process(), so that words which have
+been processed before needn't be processed again. Results are kept in
+memory, with the least recently used thrown away first, and optionally
+in a file so that they last from one run to the next.
+
+Keys include a signature of everything which went into the rules (see
+SCA.getSignature()), so results for different rules, definitions, or
+exceptions, or from a different version of this program, are never
+confused, and the cache needs no clearing when anything changes.
+"""
+
+import collections, hashlib, os, shelve
+
+##############################################################################
+
+""" Return a signature of the source and data files of this program,
+so that results saved by one version aren't used by another.
+"""
+
+def programSignature():
+    D = hashlib.sha1()
+    d = os.path.dirname(os.path.abspath(__file__))
+
+    for f in sorted(os.listdir(d)):
+        if f[:3] != "SCA" or os.path.splitext(f)[1] not in (".py", ".yaml"):
+            continue
+
+        F = open(os.path.join(d, f), "rb")
+        D.update(F.read())
+        F.close()
+
+    return D.hexdigest()
+
+##############################################################################
+
+class SCACache:
+    """ The constructor.
+    size: how many results to keep in memory
+    filename: the file to keep results in as well, or None
+    """
+    def __init__(self, size = 10000, filename = None):
+        self.size, self.H = size, collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.program = programSignature()
+        self.shelf = None
+
+        if filename is not None: self.shelf = shelve.open(filename)
+
+    """ Return the key for _word_ in _dialects_ with rules whose
+    signature is _sig_. Keys in the file have to be byte strings.
+    """
+    def makeKey(self, sig, word, dialects):
+        s = "\0".join([self.program, sig, dialects, word])
+
+        if isinstance(s, unicode): s = s.encode("utf-8")
+
+        return s
+
+    """ Return the results stored for _key_, or None. """
+    def get(self, key):
+        H = self.H.pop(key, None)
+
+        if H is None and self.shelf is not None:
+            H = self.shelf.get(key)
+
+        if H is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.H[key] = H # now the most recently used
+
+        return dict(H)
+
+    """ Store the results _H_ for _key_. """
+    def put(self, key, H):
+        self.H[key] = dict(H)
+
+        if len(self.H) > self.size: self.H.popitem(last = False)
+
+        if self.shelf is not None: self.shelf[key] = self.H[key]
+
+    """ Write the file, if any, and stop using it. """
+    def close(self):
+        if self.shelf is not None: self.shelf.close()
+        self.shelf = None
+
+##############################################################################
@@ -0,0 +1,148 @@
+# This file is part of Geoff's Sound Change Applier, version 0.8
+# (August 2010). You can obtain the latest version of this program
+# from http://gesc19764.pwp.blueyonder.co.uk/sca.html
+
+""" Compiled rule sets: an SCA object with all its rules read,
+compiled, and optimised, saved to a file so that it can be loaded
+again without doing any of that.
+
+Each file starts with a header recording what the rules were built
+from: the version of this program and of Python, a key for the
+options which affect compiling, and a hash of every file which was
+read. A file is only loaded if all of these are unchanged; otherwise
+load() returns None, and the rules should be built and saved again.
+"""
+
+from SCAdefs import *
+
+import _sre, cPickle, hashlib, os, re, sre_compile, sre_parse, sys
+import SCAcache
+
+##############################################################################
+
+# This changes whenever the layout of the files does.
+VERSION = 2
+
+HashType, PatternType = type(hashlib.sha1()), type(re.compile(""))
+
+##############################################################################
+
+""" Return the SHA-1 hash of the contents of _filename_, or None if it
+can't be read.
+"""
+
+def fileHash(filename):
+    try:
+        F = open(filename, "rb")
+    except IOError:
+        return None
+
+    D = hashlib.sha1(F.read())
+    F.close()
+
+    return D.hexdigest()
+
+""" Return the header for rules built with options _key_ from the
+files _sources_.
+"""
+
+def makeHeader(key, sources):
+    return { "version": (VERSION, sys.version, _sre.MAGIC),
+             "program": SCAcache.programSignature(),
+             "key":     key,
+             "sources": [ (f, fileHash(f)) for f in sources ] }
+
+""" Return the arguments which _sre.compile() needs to remake the
+compiled regexp _P_, which is what sre_compile.compile() does after
+parsing it. Saving these means that regexps needn't be parsed again
+when they're loaded.
+"""
+
+def patternArgs(P):
+    p = sre_parse.parse(P.pattern, P.flags)
+    code = sre_compile._code(p, P.flags)
+
+    groupindex = p.pattern.groupdict
+    indexgroup = [None] * p.pattern.groups
+
+    for k, i in groupindex.items(): indexgroup[i] = k
+
+    return (P.pattern, P.flags | p.pattern.flags, code,
+            p.pattern.groups - 1, groupindex, indexgroup)
+
+""" Objects which can't be pickled are saved as persistent IDs: the
+digests in SCA.getSignature(), and compiled regexps, for which see
+patternArgs(). The rules' own random numbers are saved as they are, so
+a seeded file gives the same ones after it's loaded.
+"""
+
+def persistentID(obj):
+    if isinstance(obj, HashType): return ("hash", obj.hexdigest())
+
+    if isinstance(obj, PatternType): return ("re",) + patternArgs(obj)
+
+    return None
+
+""" Turn what persistentID() returned back into an object. A digest
+can't be restored as it was, so the new one starts from the old one's
+value instead; SCA.getSignature() will be different from that of the
+same rules read from their files, but no less unique.
+"""
+
+def persistentLoad(pid):
+    if pid[0] == "hash": return hashlib.sha1(pid[1])
+
+    return _sre.compile(*pid[1:])
+
+##############################################################################
+
+""" Save _sca_, which was built with options _key_, to _filename_.
+The file is written under another name first and renamed, so that
+nothing else can see half of it.
+"""
+
+def save(sca, filename, key):
+    tmp = "%s.%d" % (filename, os.getpid())
+
+    try:
+        F = open(tmp, "wb")
+    except IOError:
+        raise SCAException("Can't write to '%s'", filename)
+
+    P = cPickle.Pickler(F, cPickle.HIGHEST_PROTOCOL)
+    P.persistent_id = persistentID
+
+    P.dump(makeHeader(key, sca.sources))
+    P.dump(sca)
+    F.close()
+
+    os.rename(tmp, filename)
+
+""" Return the SCA object saved in _filename_ if it was built with
+options _key_ and nothing it was built from has changed since, and
+None otherwise.
+"""
+
+def load(filename, key):
+    try:
+        F = open(filename, "rb")
+    except IOError:
+        return None
+
+    U = cPickle.Unpickler(F)
+    U.persistent_load = persistentLoad
+
+    try:
+        H = U.load()
+
+        if H != makeHeader(key, [ f for f, h in H["sources"] ]):
+            return None
+
+        return U.load()
+    except Exception:
+        # An unreadable file is no use either way.
+        return None
+    finally:
+        F.close()
+
+##############################################################################
@@ -6,7 +6,29 @@
 and not tied to a specific class.
 """
 
-import codecs
+import codecs, os, yaml
+
+##############################################################################
+
+# The YAML files which have been loaded; see loadYAML().
+yamlfiles = {}
+
+# The C loader is much faster, but PyYAML may have been built without it.
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+""" Return the contents of the YAML file _name_, which should be in the
+same directory as this program. Each file is read only once; the same
+object is returned each time, so it shouldn't be changed.
+"""
+
+def loadYAML(name):
+    if name not in yamlfiles:
+        f = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              name), "r")
+        yamlfiles[name] = yaml.load(f, Loader = YAMLLoader)
+        f.close()
+
+    return yamlfiles[name]
 
 ##############################################################################
 
@@ -127,4 +149,20 @@ def makeNumList(arg, delim1 = ',', delim2 = '-'):
 
     return L
 
+""" Yield the items of _it_ in lists of _size_; the last may be shorter.
+"""
+
+def chunks(it, size):
+    L = []
+
+    for x in it:
+        L.append(x)
+
+        if len(L) < size: continue
+
+        yield L
+        L = []
+
+    if len(L) > 0: yield L
+
 ##############################################################################
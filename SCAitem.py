@@ -4,12 +4,60 @@
 
 """ This file defines the types of item which SCA uses for matching."""
 
-import re, random
+import re, hashlib
 
 from SCAdefs import *
 
 ##############################################################################
 
+""" Work out which substrings any text matching the regexp fragment
+_rexp_ must contain. The result is a list of one-element tuples in the
+format of SCAItem.getNeeds(), or None if _rexp_ contains an
+alternation, a class, a group, a counted repeat, or an escape such as
+'\\s', in which case nothing can be said about the part it belongs to.
+"""
+
+def literalNeeds(rexp):
+    L, s, i, n = [], "", 0, len(rexp)
+
+    while i < n:
+        c, i = rexp[i], i + 1
+
+        if c in '|[](){}': return None
+
+        if c == '\\':
+            if i == n or rexp[i].isalnum(): return None
+            s, i = s + rexp[i], i + 1
+            continue
+
+        if c not in '.^$?*+':
+            s += c
+            continue
+
+        if c in '?*': s = s[:-1] # the last character is optional
+
+        if len(s) > 0: L.append((s,))
+        s = ""
+
+    if len(s) > 0: L.append((s,))
+
+    return L
+
+""" Does the regexp fragment _rexp_ contain a '|' which isn't escaped?
+"""
+
+def hasBar(rexp):
+    i, n = 0, len(rexp)
+
+    while i < n:
+        if rexp[i] == '\\': i += 1
+        elif rexp[i] == '|': return True
+        i += 1
+
+    return False
+
+##############################################################################
+
 """ The base class of all items; not used by itself. Inherited methods
 in subclasses are in general commented here only.
 
@@ -144,6 +192,23 @@ class SCAItem:
     """ Ensure that this item is valid; raise an exception of not. """
     def validate(self, verbose): pass
 
+    """ Return a list of tuples of strings; any text which this item
+    matches must contain at least one string from each tuple. None
+    means that the part containing this item can't be analysed.
+    """
+    def getNeeds(self): return []
+
+    """ If this item always matches exactly one character out of a
+    fixed set, return those characters as a string; otherwise return
+    None.
+    """
+    def getChars(self): return None
+
+    """ If this item always matches exactly the same text, return it;
+    otherwise return None.
+    """
+    def getLiteral(self): return None
+
 ##############################################################################
 
 """ Literals which need no further conversion; typically strings,
@@ -155,6 +220,33 @@ class SCALiteral(SCAItem):
     def compileText(self, s): return s
     def compileRE(  self, s): return s
     def convert(self, *args):  return self.text
+    def getNeeds(self):        return literalNeeds(self.rexp)
+
+    def getChars(self):
+        s = self.rexp
+
+        if len(s) == 2 and s[0] == '\\' and s[1] in '.|?+*<[{%#\\\'"()':
+            return s[1]
+
+        if len(s) != 1 or s in '.^$?*+|\\': return None
+
+        return s
+
+    def getLiteral(self):
+        s, i, n = "", 0, len(self.rexp)
+
+        while i < n:
+            c, i = self.rexp[i], i + 1
+
+            if c == '\\':
+                if i == n or self.rexp[i].isalnum(): return None
+                c, i = self.rexp[i], i + 1
+            elif c in '.^$?*+|()[]{}':
+                return None
+
+            s += c
+
+        return s
 
 ##############################################################################
 
@@ -198,6 +290,8 @@ class SCAString(SCAItem):
     """ Strings convert to their values. """
     def convert(self, *args): return self.re.pattern
 
+    def getNeeds(self): return literalNeeds(self.rexp)
+
 ##############################################################################
 
 """ Part references, i.e. '%'. '<', and '>'.
@@ -228,7 +322,7 @@ class SCAVector(SCAItem):
     be taken into account.
     """
     def __init__(self, name, quants, *args):
-        self.quants = quants
+        self.quants, self.tables = quants, {}
         SCAItem.__init__(self, name, *args)
         if self.ref is None: self.ref = self.index + 1
 
@@ -247,7 +341,13 @@ class SCAVector(SCAItem):
         return self.makeList(self.values, *self.getRexpDelims()) + self.quants
 
     def convert(self, R, s, *args):
-        if self.random: n = random.randrange(len(self))
+        if not self.random:
+            if R not in self.tables: self.tables[R] = self.getTable(R)
+
+            T = self.tables[R]
+            if T is not None and s in T: return T[s]
+
+        if self.random: n = self.parent.rng.randrange(len(self))
         else: n = R[self.ref].find(s)
 
         if n >= len(self): return ""
@@ -255,6 +355,32 @@ class SCAVector(SCAItem):
         if ret == '0': ret = ''
         return ret
 
+    """ Return a dictionary which maps each value of the item in part
+    _R_ which this item refers to onto what convert() gives for it, or
+    None if that isn't fixed. As with find(), the first occurrence of
+    a value counts.
+    """
+    def getTable(self, R):
+        if self.random: return None
+
+        try:
+            I = R[self.ref]
+        except IndexError:
+            return None
+
+        if not isinstance(I, SCAVector): return None
+
+        H = {}
+
+        for n, t in enumerate(I.values):
+            if t in H: continue
+
+            if n >= len(self): H[t] = ""
+            elif self.values[n] == '0': H[t] = ""
+            else: H[t] = self.values[n]
+
+        return H
+
     """ Retrieve the index of _s_. For example, finding 'c' in '<abc>'
     returns 2.
     """
@@ -265,6 +391,24 @@ class SCAVector(SCAItem):
     def validate(self, verbose):
         self.validateRef(1, self.ref, True, verbose)
 
+    """ Any of our values will do, unless we're optional or the values
+    have special meanings inside '[...]'.
+    """
+    def getNeeds(self):
+        if self.quants[:1] in ('*', '?') or len(self.values) == 0:
+            return []
+
+        if self.values[0] == '^': return []
+
+        for c in '[]\\-':
+            if c in self.values: return []
+
+        return [tuple(sorted(set(self.values)))]
+
+    def getChars(self):
+        if self.quants or len(self.getNeeds()) == 0: return None
+        return self.values
+
 ##############################################################################
 
 """ Categories, i.e. SCAVectors of symbols: <abc>, <+def>, and so on. """
@@ -309,7 +453,8 @@ class SCAFeature(SCAVector):
         ret = self.getFeature(L.pop(0))
 
         for t in L:
-            ret = "".join([c for c in ret if c in self.getFeature(t)])
+            T = set(self.getFeature(t))
+            ret = "".join([c for c in ret if c in T])
 
         self.values = ret
 
@@ -357,6 +502,25 @@ class SCAList(SCAVector):
         if self.extrexp: return self.extrexp
         return self.getRexp()
 
+    """ Any of our values will do, but only if they're plain text. """
+    def getNeeds(self):
+        if self.quants[:1] in ('*', '?') or len(self.values) == 0:
+            return []
+
+        for t in self.values:
+            N = literalNeeds(t)
+            if N is None or N != [(t,)]: return []
+
+        return [tuple(self.values)]
+
+    def getChars(self):
+        if self.quants: return None
+
+        for t in self.values:
+            if len(t) != 1 or t in '.^$?*+|\\()[]{}': return None
+
+        return "".join(self.values)
+
 ##############################################################################
 
 """ Indexes into BEFORE, which are represented by numbers. """
@@ -398,6 +562,15 @@ class SCABlend(SCAItem):
         self.catpart, self.catindex, self.cat = self.parse(L[0], "cat")
         self.pospart, self.posindex, self.pos = self.parse(L[1], "index")
 
+        # Map each symbol in the second category onto the one in the
+        # same place in the first, as convert() would.
+        self.table = {}
+
+        if self.cat is not None and self.pos is not None:
+            for i, c in enumerate(self.pos):
+                if c not in self.table and i < len(self.cat):
+                    self.table[c] = self.cat[i]
+
     """ Work out the part and index from half of a blend. """
     def parse(self, s, t):
         m, c = blendre.match(s), s
@@ -437,6 +610,8 @@ class SCABlend(SCAItem):
         else:
             c = groups[self.pospart][self.posindex]
 
+        if c in self.table: return self.table[c]
+
         return self.cat[self.pos.find(c)]
         
     def indexable(self): return True
@@ -453,18 +628,39 @@ class SCABlend(SCAItem):
 should not be processed by specific rules.
 """
 class SCAExceptionWords:
-    def __init__(self): self.H = {}
+    def __init__(self):
+        # Maps tuples of a rule name and a dialect to the set of words
+        # which are exceptions to the rule in that dialect. A dialect
+        # of None stands for all of them.
+        self.H = {}
+
+        # The names of the rules which have any exceptions.
+        self.names = set()
+
+        # A digest of all the exceptions; see SCA.getSignature().
+        self.digest = hashlib.sha1()
 
     """ Add an exception.
     _name_: the name of the rule. This is not easily checked; if there
     is no rule with this name, the exception will be ignored.
-    _words_: the words to which the exception will apply
-    _dialects_: the dialects; None for all
+    _words_: the words to which the exception will apply, as a list or
+    as a string separated by spaces
+    _dialects_: the dialects; None, empty or '*' for all
     """
     def add(self, name, words, dialects = None):
-        if name not in self.H: self.H[name] = []
-            
-        self.H[name].append((dialects, words))
+        s = repr((name, words, dialects))
+        self.digest.update(s)
+
+        if isinstance(words, basestring): words = words.split()
+
+        if dialects in (None, "", "*"): dialects = [None]
+
+        for d in dialects:
+            if (name, d) not in self.H: self.H[name, d] = set()
+
+            self.H[name, d].update(words)
+
+        self.names.add(name)
 
     """ Read some exceptions from _filename_. We expect one of more of:
     @RULE dialects
@@ -472,15 +668,15 @@ class SCAExceptionWords:
     more words
     """
     def readFromFile(self, filename, enc):
-        f = codecs.open(filename, "r", enc)
-
-        if f is None:
+        try:
+            f = codecs.open(filename, "r", enc)
+        except IOError:
             raise SCAException("Exception file '%s' not found", filename)
 
         lastname, lastdial = None, None
 
-        for line in f.readlines():
-            line = line[:-1]
+        for line in f:
+            line = line.rstrip("\r\n")
 
             if len(line) == 0 or line[0] == '#': continue
 
@@ -499,15 +695,14 @@ class SCAExceptionWords:
 
         f.close()
 
+    """ Are there any exceptions for rule _name_? """
+    def has(self, name): return name in self.names
+
     """ Is _w_ in dialect _d_ an exception for rule _name_? """
     def isException(self, name, w, d):
-        if name not in self.H: return False
-
-        for dial, L in self.H[self]:
-            if w not in L: continue
-            if dial is not None and d not in dial: continue
-            return True
+        if name not in self.names: return False
 
-        return False
+        return w in self.H.get((name, d), ()) or \
+               w in self.H.get((name, None), ())
 
 ##############################################################################
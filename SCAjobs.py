@@ -0,0 +1,89 @@
+# This file is part of Geoff's Sound Change Applier, version 0.8
+# (August 2010). You can obtain the latest version of this program
+# from http://gesc19764.pwp.blueyonder.co.uk/sca.html
+
+""" Processing the lines of a lexicon in several processes at once.
+
+The rules are built once, before the worker processes are started, and
+each worker gets a copy of them when it's forked, so nothing needs to
+be sent to them but the lines. Lines are sent out in chunks, and the
+results are put back in the order the chunks were sent, so the output
+is the same as from one process. Only a few chunks are out at any
+time, so memory use doesn't grow with the lexicon.
+
+Every word must give the same results whichever process handles it,
+and whatever it handled before. That isn't so if rules use random
+numbers which aren't seeded with each word (see SCA.getRandom()), or
+if groups change as they're used, so then everything is done in this
+process; see SCA.isCacheable().
+"""
+
+from SCA import *
+
+import collections, multiprocessing
+
+##############################################################################
+
+# What the workers use; these are set before they're forked.
+applier, sca = None, None
+
+# How long to wait for a chunk. Python 2 ignores Ctrl-C while waiting
+# without a timeout.
+timeout = 1e6
+
+""" Start a worker: results which it caches are kept in memory only,
+since the file is still the parent process's.
+"""
+
+def init():
+    if sca.cache is not None: sca.cache.shelf = None
+
+""" Process _lines_ in a worker, and return them formatted; see
+SCApplier.formatLines().
+"""
+
+def work(lines): return list(applier.formatLines(sca, lines))
+
+##############################################################################
+
+""" Can the words be processed through _S_ in several processes at once
+with the same results as in one?
+"""
+
+def canSplit(S): return S.isCacheable()
+
+""" Process _lines_, as yielded by SCApplier.readFile(), through _S_
+in _jobs_ worker processes, and yield them formatted in the same order
+as SCApplier.formatLines() would. Each worker is sent _size_ lines at
+a time.
+"""
+
+def formatLines(A, S, lines, jobs, size = 500):
+    global applier, sca
+
+    if jobs <= 1 or not canSplit(S):
+        for s in A.formatLines(S, lines): yield s
+        return
+
+    applier, sca = A, S
+
+    P, Q = multiprocessing.Pool(jobs, init), collections.deque()
+
+    try:
+        for L in chunks(lines, size):
+            Q.append(P.apply_async(work, (L,)))
+
+            # Keep a couple of chunks waiting for each worker.
+            if len(Q) < 2 * jobs: continue
+
+            for s in Q.popleft().get(timeout): yield s
+
+        while len(Q) > 0:
+            for s in Q.popleft().get(timeout): yield s
+
+        P.close()
+    finally:
+        P.terminate()
+        P.join()
+
+##############################################################################
@@ -0,0 +1,441 @@
+# This file is part of Geoff's Sound Change Applier, version 0.8
+# (August 2010). You can obtain the latest version of this program
+# from http://gesc19764.pwp.blueyonder.co.uk/sca.html
+
+""" Optional optimisations, which replace runs of rules in a group
+with single objects which give the same results but do less work.
+Each such object behaves like a rule as far as its group is
+concerned, and falls back to the original rules when they are being
+traced or their assertions checked.
+"""
+
+from SCArule import *
+
+##############################################################################
+
+""" Would replacing rules in group _G_ change what its parameters do?
+Shuffling, 'ruleprob', and 'max' all work on individual rules.
+"""
+
+def canOptimise(G):
+    P = G.params
+    return not P["shuffle"] and P["ruleprob"] is None and P["max"] is None
+
+""" Optimise the rules in group _G_ of _sca_ and any groups inside it.
+"""
+
+def optimiseGroup(sca, G):
+    for R in G.rules:
+        if isinstance(R, SCARuleGroup): optimiseGroup(sca, R)
+
+    if not canOptimise(G): return
+
+    SCATransducer.optimise(sca, G)
+    SCAFusedRules.optimise(sca, G)
+
+##############################################################################
+
+""" A run of rules, each of which replaces single characters whatever
+their context (see SCARule.getCharMap()), is a finite-state transducer
+with a single state. Composing their maps for each dialect gives one
+which does the same as the whole run, and which can be applied in one
+pass with unicode.translate().
+"""
+
+class SCATransducer:
+    """ Replace every run of suitable rules in group _G_ of _sca_. """
+    @staticmethod
+    def optimise(sca, G):
+        P, after = sca.persistent, None
+
+        # Persistent rules run after every rule, so they have to be
+        # composed into the map too.
+        if len(P.rules) > 0:
+            if not canOptimise(P): return
+
+            after = []
+
+            for R in P.rules:
+                if not SCATransducer.suitable(sca, R): return
+                after.append((R, R.getCharMap()))
+
+        L, run = [], []
+
+        for R in G.rules + [None]:
+            if R is not None and SCATransducer.suitable(sca, R):
+                run.append((R, R.getCharMap()))
+                continue
+
+            if len(run) > 0: L.append(SCATransducer(sca, run, after))
+            if R is not None: L.append(R)
+            run = []
+
+        G.rules = L
+
+    """ Can rule _R_ in _sca_ be part of a transducer? """
+    @staticmethod
+    def suitable(sca, R):
+        if not isinstance(R, SCARule): return False
+        if R.name is not None and sca.exceptions.has(R.name): return False
+        return R.getCharMap() is not None
+
+    """ The constructor.
+    sca:   the SCA object to which the rules belong
+    run:   a list of tuples of rules and their maps
+    after: a list like _run_ for the persistent rules, or None
+    """
+    def __init__(self, sca, run, after):
+        self.sca, self.run, self.after = sca, run, after
+        self.rules = [R for R, H in run]
+        self.tables = {}
+        self.kind = "transducer"
+        self.text = "\n".join([R.text for R in self.rules])
+
+    """ The rules are never random; see SCARule.isRandom(). """
+    def isRandom(self): return False
+
+    """ Return the result of applying map _H2_ to the output of map
+    _H1_.
+    """
+    def compose(self, H1, H2):
+        H = {}
+
+        for c in set(H1.keys() + H2.keys()):
+            t = "".join([H2.get(x, x) for x in H1.get(c, c)])
+            if t != c: H[c] = t
+
+        return H
+
+    """ Return the table for unicode.translate() in dialect _d_.
+    Dialects to which the same rules apply share a table, so that
+    process() can tell that they give the same results.
+    """
+    def getTable(self, d):
+        if d in self.tables: return self.tables[d]
+
+        L = self.run + (self.after or [])
+        k = tuple([R.appropriate(d) for R, M in L])
+
+        if k in self.tables:
+            self.tables[d] = self.tables[k]
+            return self.tables[k]
+
+        H = {}
+
+        for i, (R, M) in enumerate(self.run):
+            if R.appropriate(d): H = self.compose(H, M)
+
+            if self.after is None or i == len(self.run) - 1: continue
+
+            for R, M in self.after:
+                if R.appropriate(d): H = self.compose(H, M)
+
+        T = dict([(ord(c), unicode(t)) for c, t in H.items()])
+        self.tables[d] = self.tables[k] = T
+
+        return T
+
+    """ Apply the rules to some words; see SCARule.process(). The last
+    rule is followed by the persistent rules in the group, not here.
+    """
+    def process(self, H, E, P, **extras):
+        slow = extras.get("func") is not None or extras.get("doassert")
+
+        for d in H.keys():
+            if not isinstance(H[d], unicode): slow = True
+
+        if not slow:
+            done = {}
+
+            for d in H.keys():
+                T = self.getTable(d)
+                k = id(T), H[d]
+
+                if k not in done: done[k] = H[d].translate(T)
+                H[d] = done[k]
+
+            return
+
+        for i, R in enumerate(self.rules):
+            if i > 0 and P is not None: P.settle(H, E, **extras)
+            R.process(H, E, P, **extras)
+
+##############################################################################
+
+""" Return the set of characters which text matching the regexp
+fragment _rexp_ can contain, or None if that can't be worked out
+simply. Anchors and quantifiers match no characters themselves.
+"""
+
+def regexChars(rexp):
+    S, i, n = set(), 0, len(rexp)
+
+    while i < n:
+        c, i = rexp[i], i + 1
+
+        if c == '\\':
+            if i == n or rexp[i].isalnum(): return None
+            S.add(rexp[i])
+            i += 1
+        elif c in '.[](){}': return None
+        elif c not in '^$?*+|': S.add(c)
+
+    return S
+
+""" Return the set of characters which text matching item _I_ in PRE,
+BEFORE, or POST can contain, or None if that can't be worked out.
+"""
+
+def matchChars(I):
+    if isinstance(I, SCAZero): return set()
+
+    if isinstance(I, (SCALiteral, SCAString)): return regexChars(I.rexp)
+
+    if isinstance(I, SCAList):
+        S = set()
+
+        for t in I.values:
+            T = regexChars(t)
+            if T is None: return None
+            S |= T
+
+        return S
+
+    if isinstance(I, (SCACategory, SCAFeature)):
+        if len(I.values) == 0 or I.values[0] == '^': return None
+
+        for c in '[]\\-':
+            if c in I.values: return None
+
+        return set(I.values)
+
+    return None # part references and anything else
+
+##############################################################################
+
+""" Rules which touch different characters can often be applied in
+either order with the same result, in which case a run of them can be
+applied in a single pass over the word: the combined regexp has a
+named alternative for each rule, and whichever alternative matches
+says which rule converts the text.
+
+For this to give the same result as applying the rules one by one,
+each rule in a run must:
+- match characters which no other rule in the run matches, so that
+  the rules never compete for the same text;
+- not produce characters which a later rule matches, so that it
+  doesn't feed it;
+- match at least one character, and not delete what it matches
+  unless it is the last rule in the run, so that it can't bring
+  together characters which a later rule would then match.
+"""
+
+class SCAFusedRules:
+    # Python supports only 100 groups in a regexp, and each rule needs
+    # one more than its own regexp has.
+    maxGroups = 99
+
+    """ Replace every run of suitable rules in group _G_ of _sca_. """
+    @staticmethod
+    def optimise(sca, G):
+        # Persistent rules run between every pair of rules.
+        if len(sca.persistent.rules) > 0: return
+
+        L, run, used, made, n = [], [], set(), set(), 0
+
+        for R in G.rules + [None]:
+            T = None
+            if R is not None: T = SCAFusedRules.analyse(sca, R)
+
+            if T is not None and \
+               n + R.re.groups + 1 <= SCAFusedRules.maxGroups:
+                chars, out, deletes = T
+
+                # Only the last rule may delete, so a rule which
+                # follows one which does starts a new run.
+                if not (chars & used or chars & made or
+                        len(run) > 0 and run[-1][1]):
+                    run.append((R, deletes))
+                    used |= chars
+                    made |= out
+                    n += R.re.groups + 1
+                    continue
+
+            if len(run) > 1: L.append(SCAFusedRules([Q for Q, b in run]))
+            else:            L += [Q for Q, b in run]
+
+            run, used, made, n = [], set(), set(), 0
+
+            if T is None:
+                if R is not None: L.append(R)
+                continue
+
+            run.append((R, T[2]))
+            used, made = set(T[0]), set(T[1])
+            n = R.re.groups + 1
+
+        G.rules = L
+
+    """ If rule _R_ in _sca_ could be part of a run, return a tuple of
+    the characters it matches, those it produces, and whether it can
+    delete what it matches; otherwise return None.
+    """
+    @staticmethod
+    def analyse(sca, R):
+        if not isinstance(R, SCARule) or R.once or R.reverse or R.random:
+            return None
+
+        # str.replace() and unicode.translate() are faster than any
+        # search; see SCARule.classify().
+        if R.kind in ("replace", "translate"): return None
+
+        if R.name is not None and sca.exceptions.has(R.name): return None
+
+        if R.re.groups != R.postgroup or minWidth(R.rexp) == 0: return None
+
+        chars = set()
+
+        for P in R.pre, R.before, R.post:
+            for I in P.items:
+                S = matchChars(I)
+                if S is None: return None
+                chars |= S
+
+        # Strings could be looked up by the converted text.
+        if '$' in chars: return None
+
+        out, least = set(), 0
+
+        for I in R.after.items:
+            if isinstance(I, (SCALiteral, SCAString)):
+                out |= set(I.convert())
+                least += len(I.convert())
+            elif isinstance(I, SCAVector):
+                try:
+                    n = len(R.getPart(I.part)[I.ref])
+                except Exception:
+                    return None
+
+                for t in I.values:
+                    if t[:1] == '$': return None
+                    if t not in ('', '0'): out |= set(t)
+
+                if '' not in I.values and '0' not in I.values and \
+                   len(I.values) >= n:
+                    least += 1
+            elif isinstance(I, SCABlend):
+                if I.cat is None: return None
+                out |= set(I.cat)
+                least += 1
+            elif not isinstance(I, (SCAZero, SCAIndex, SCAPartref)):
+                return None
+
+        # A rule which can replace what it matches with nothing can
+        # also let '#' in PRE match again; see SCARule.applyForward().
+        deletes = least == 0 and \
+                  (R.banana or minWidth(R.pre.getExtRexp() +
+                                        R.post.getExtRexp()) == 0)
+
+        if deletes and R.caret: return None
+
+        return chars, out, deletes
+
+    """ The constructor.
+    rules: the rules to apply in a single pass
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.res = {}
+        self.kind = "fused"
+        self.text = "\n".join([R.text for R in self.rules])
+
+    """ The rules are never random; see SCARule.isRandom(). """
+    def isRandom(self): return False
+
+    """ Return the combined regexp for the rules which apply to
+    dialect _d_, and a list of tuples of those rules and the index of
+    their first group in the groups of a match, or None if there are
+    no such rules. Dialects to which the same rules apply share these.
+    """
+    def getRegexp(self, d):
+        if d in self.res: return self.res[d]
+
+        k = tuple([R.appropriate(d) for R in self.rules])
+
+        if k in self.res:
+            self.res[d] = self.res[k]
+            return self.res[k]
+
+        L, n = [], 1
+
+        for R in self.rules:
+            if not R.appropriate(d): continue
+            L.append((R, n))
+            n += R.re.groups + 1
+
+        ret = None
+
+        if len(L) > 0:
+            rexp = "|".join(["(?P<r%d>%s)" % (i, R.rexp)
+                             for i, (R, g) in enumerate(L)])
+            ret = re.compile(rexp), L
+
+        self.res[d] = self.res[k] = ret
+
+        return ret
+
+    """ Apply the rules to _word_ in dialect _d_; see
+    SCARule.applyForward(), which this follows.
+    """
+    def apply(self, d, word):
+        T = self.getRegexp(d)
+
+        if T is None: return word
+
+        rexp, rules = T
+        L, n, last, size = [], 0, 0, len(word)
+
+        while True:
+            m = rexp.search(word, n)
+
+            if m is None: break
+
+            R, i = rules[int(m.lastgroup[1:])]
+            s = m.start()
+
+            groups, items = R.split(m.groups(), i)
+            pre, before, post = groups
+            t = R.after.convert(R, groups, items)
+
+            if R.banana: e, t = m.end(i + 2), pre + t
+            else:        e, t = m.end(),      pre + t + post
+
+            L.append(word[last:s])
+            L.append(t)
+
+            last, n = e, max(e, s + 1)
+
+            if n >= size: break
+
+        L.append(word[last:])
+
+        return "".join(L)
+
+    """ Apply the rules to some words; see SCARule.process(). """
+    def process(self, H, E, P, **extras):
+        if extras.get("func") is not None or extras.get("doassert"):
+            for i, R in enumerate(self.rules):
+                if i > 0 and P is not None: P.settle(H, E, **extras)
+                R.process(H, E, P, **extras)
+
+            return
+
+        done = {}
+
+        for d in H.keys():
+            k = id(self.getRegexp(d)), H[d]
+
+            if k not in done: done[k] = self.apply(d, H[d])
+            H[d] = done[k]
+
+##############################################################################
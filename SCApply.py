@@ -4,7 +4,7 @@
 
 from SCA import *
 
-import sys, optparse, yaml, codecs, random, time
+import sys, optparse, codecs, time, bz2, gzip, os, subprocess
 
 banner = "Geoff's Sound Change Applier, version 0.8 (August 2010)"
 info1  = "You can obtain the latest version of this program"
@@ -41,9 +41,10 @@ class SCApplier():
 
         if opts.encoding is None: opts.encoding = "utf-8"
 
-        S = SCA(self.defs, opts.encoding)
-        S.readFromFile(opts.scfile)
-        if opts.excfile: S.loadExceptions(opts.excfile)
+        S = self.build(opts)
+
+        if opts.cache or opts.cachefile:
+            S.setCache(opts.cache or 10000, opts.cachefile)
 
         if opts.showdefs:
             S.showDefs()
@@ -59,8 +60,7 @@ class SCApplier():
         self.dialects = opts.dialects or S.dialects
 
         if opts.seed is not None:
-            if opts.seed == 'time': random.seed()
-            else: random.seed(opts.seed)
+            S.dir_seed(opts.seed)
         else:
             S.setLastWord("")
 
@@ -73,67 +73,259 @@ class SCApplier():
 
         if self.opts.testfile: self.doTestFile(S)
 
-        if self.opts.lexfile: self.doLexFile(S, self.opts.outfile)
+        if self.opts.watch:
+            self.doWatch()
+            S.closeCache()
+            return
+
+        if self.opts.lexfile:
+            self.doLexFile(S, self.opts.outfile, self.opts.jobs)
 
         try:
             for word in args: self.process_word(S, word)
         except SCAException, e:
             print e.s
 
+        S.closeCache()
+
+    """ Return an SCA instance with the rules and exceptions named in
+    _opts_. With '-b', it's loaded from the compiled rules in that file
+    if they're up to date, and otherwise saved there once built.
+    """
+    def build(self, opts):
+        if opts.compiled:
+            import SCAcompiled
+
+            key = (opts.scfile, opts.excfile, sorted(self.defs.items()),
+                   opts.encoding, opts.optimise)
+            S = SCAcompiled.load(opts.compiled, key)
+
+            if S is not None:
+                # The random numbers were saved as they were after the
+                # rules were read, so a fixed seed gives the same ones as
+                # reading the rules would; a seed of 'time' has to read
+                # the clock again.
+                if S.seed == 'time': S.dir_seed(S.seed)
+                return S
+
+        S = SCA(self.defs, opts.encoding)
+        S.readFromFile(opts.scfile)
+        if opts.excfile: S.loadExceptions(opts.excfile)
+        if opts.optimise: S.optimise()
+
+        if opts.compiled: SCAcompiled.save(S, opts.compiled, key)
+
+        return S
+
+    """ Open file _name_ for reading as bytes, decompressing it if its
+    name ends in '.gz', '.bz2', or '.xz'; '-' means standard input.
+    Without the lzma module, which Python 2 doesn't have as standard,
+    '.xz' files are decompressed by the 'xz' program.
+    """
+    def openInput(self, name):
+        if name == "-": return sys.stdin
+
+        ext = os.path.splitext(name)[1]
+
+        try:
+            if ext == ".gz":  return gzip.open(name, "rb")
+            if ext == ".bz2": return bz2.BZ2File(name, "rb")
+            if ext != ".xz":  return open(name, "rb")
+
+            try:
+                import lzma
+            except ImportError:
+                try:
+                    from backports import lzma
+                except ImportError:
+                    lzma = None
+
+            if lzma is not None: return lzma.open(name, "rb")
+
+            open(name, "rb").close()
+
+            P = subprocess.Popen(["xz", "-dc", name],
+                                 stdout = subprocess.PIPE)
+            return P.stdout
+        except (IOError, OSError):
+            raise SCAException("Can't read '%s'", name)
+
+    """ Open file _name_ for writing as bytes; '-' means standard
+    output.
+    """
+    def openOutput(self, name):
+        if name == "-": return sys.stdout
+
+        try:
+            return open(name, "wb")
+        except IOError:
+            raise SCAException("Can't write to '%s'", name)
+
     """ Read lines from file _name_, split them into fields, and yield
-    them together with the line number.
+    them together with the line number. The file is read and decoded
+    _size_ bytes at a time, so files of any size can be read.
     """
-    def readFile(self, name):
-        f, n = codecs.open(name, "r", self.opts.encoding), 0
-            
-        for line in f.readlines():
-            n += 1
-            L = line[:-1].split(self.opts.insep)
-                
-            yield n, L
+    def readFile(self, name, size = 65536):
+        F = self.openInput(name)
+        D = codecs.getincrementaldecoder(self.opts.encoding)()
+        n, rest = 0, u""
+
+        while True:
+            b = F.read(size)
+            L = (rest + D.decode(b, len(b) == 0)).split("\n")
+            rest = L.pop()
+
+            for line in L:
+                n += 1
+                yield n, line.split(self.opts.insep)
 
-        f.close()
+            if len(b) == 0: break
+
+        if len(rest) > 0: yield n + 1, rest.split(self.opts.insep)
+
+        if F is not sys.stdin: F.close()
 
     """ Process a file which contains words. The file name is taken
     from the '-l' command-line argument.
     _S_: the SCA instance with which to process the words
     _outfile_: name of a file to write the output to (may be None); this
     comes from '-o'.
+    _jobs_: how many processes to use when writing to _outfile_; this
+    comes from '-j'.
+    """
+    def doLexFile(self, S, outfile, jobs = 1):
+        lines = self.readFile(self.opts.lexfile)
+
+        if outfile is None:
+            for n, L in lines:
+                for word in self.getFields(L): self.process_word(S, word)
+
+            return
+
+        F = self.openOutput(outfile)
+
+        if jobs > 1:
+            import SCAjobs
+
+            if not SCAjobs.canSplit(S):
+                sys.stderr.write("Using one process, since the results " \
+                                 "depend on more than each word.\n")
+
+            self.writeLines(F, SCAjobs.formatLines(self, S, lines, jobs))
+        else:
+            self.writeLines(F, self.formatLines(S, lines))
+
+        if F is not sys.stdout: F.close()
+
+    """ Process the words in _lines_, as yielded by readFile(), through
+    _S_, and yield each line with the results added, formatted for the
+    output file. The words are processed _size_ lines at a time; see
+    SCA.process_many().
+    """
+    def formatLines(self, S, lines, size = 1000):
+        w = self.opts.width or 15
+
+        for B in chunks(lines, size):
+            words = [ word for n, L in B
+                      if n > 1 or not self.opts.header
+                      for word in self.getFields(L) ]
+
+            T = S.process_many(words, self.dialects)
+
+            for n, L in B:
+                if n == 1 and self.opts.header:
+                    L.extend(self.dialects)
+                else:
+                    for word in self.getFields(L): L.extend(next(T))
+
+                if self.opts.sep is not None:
+                    s = self.opts.sep.join(L)
+                else:
+                    s = "".join(["%-*s" % (w, t) for t in L])
+
+                yield s + "\n"
+
+    """ Write _lines_ to file _F_, encoding and writing _size_ of them
+    at a time.
     """
-    def doLexFile(self, S, outfile):
-        fout, w = None, self.opts.width or 15
+    def writeLines(self, F, lines, size = 1000):
+        E, B = codecs.getincrementalencoder(self.opts.encoding)(), []
 
-        if outfile is not None:
-            fout = codecs.open(outfile, "w", self.opts.encoding)
+        for s in lines:
+            B.append(s)
 
-            if fout is None:
-                raise SCAException("Can't write to '%s'", outfile)
+            if len(B) < size: continue
+
+            F.write(E.encode("".join(B)))
+            B = []
+
+        F.write(E.encode("".join(B), True))
+
+    """ Return the fields of _L_ which hold words, according to '-f'.
+    This is a new list, since doLexFile() adds the results to _L_.
+    """
+    def getFields(self, L):
+        if self.opts.fields is None: return L[:]
+
+        return [ L[i] for i in self.opts.fields if 0 <= i < len(L) ]
+
+    """ Process the words in the file given by '-l', and then again
+    whenever the rules change, showing which results have changed and
+    rewriting the file given by '-o', if any; see SCAwatch.py.
+    """
+    def doWatch(self):
+        import SCAwatch
+
+        if not self.opts.lexfile:
+            raise SCAException("Watching needs a file of words from '-l'")
+
+        words = []
 
         for n, L in self.readFile(self.opts.lexfile):
-            if self.opts.fields is None: words = L
-            else:
-                words = [ L[i] for i in self.opts.fields
-                          if 0 <= i < len(L) ]
+            if n > 1 or not self.opts.header: words += self.getFields(L)
 
-            if fout is None:
-                for word in words: self.process_word(S, word)
-                continue
+        W = SCAwatch.SCAWatcher(lambda: self.build(self.opts), words,
+                                self.opts.dialects)
+        self.watcher = W
+
+        self.showUpdate(*W.update())
+        W.watch(self.showUpdate, self.showError)
+
+    """ Show what changed when the rules were read again by the
+    SCAWatcher; see SCAWatcher.update() for the arguments.
+    """
+    def showUpdate(self, n, R, changes):
+        W = self.watcher
+
+        if self.opts.outfile is not None:
+            self.doLexFile(W, self.opts.outfile)
+
+        for word, old, new in changes:
+            if old is None: continue
+
+            for d in sorted(new.keys()):
+                if old.get(d) == new[d]: continue
+
+                t = "%s %s: %s -> %s" % (word, d, old.get(d), new[d])
+
+                if self.opts.colour:
+                    t = cols(word, 35) + " " + cols(d, 32) + ": " + \
+                        cols(old.get(d), 31) + " -> " + cols(new[d], 33)
+
+                print t.encode(self.opts.encoding)
 
-            if n == 1 and self.opts.header:
-                for d in self.dialects: L.append(d)
-            else:
-                for word in words:
-                    H = S.process(word, self.dialects)
-                    for d in self.dialects: L.append(H[d])
+        if   R is None:                   s = "the start"
+        elif isinstance(R, SCARuleGroup): s = "group '%s'" % R.name
+        else:                             s = "'%s'" % R.text
 
-            if self.opts.sep is not None:
-                s = self.opts.sep.join(L)
-            else:
-                s = "".join(["%-*s" % (w, t) for t in L])
+        s = "Ran %d words from %s (stage %d of %d) in %.2fs; " \
+            "%d changed.\n" % (len(W.words), s, n + 1, len(W.marks),
+                                W.elapsed, len(changes))
 
-            fout.write(s + "\n")
+        sys.stderr.write(s.encode(self.opts.encoding))
 
-        if fout is not None: fout.close()
+    """ Show an error from reading the rules while watching them. """
+    def showError(self, e): print e.s
 
     """ Process a test file through _S_, whose name comes from '-t',
     and report any differences.
@@ -281,7 +473,7 @@ class SCApplier():
 
 ##############################################################################
 
-Y  = yaml.load(file("SCAparams.yaml", "r"))
+Y  = loadYAML("SCAparams.yaml")
 OP = optparse.OptionParser(version = Y['version'])
 S  = SCApplier()
 
@@ -5,11 +5,132 @@
 from SCAdefs import *
 from SCAitem import *
 
-import random, string, yaml
+import sre_constants, sre_parse, string
 
 ##############################################################################
 
-chartypes = yaml.load(file("SCAchars.yaml", "r"))
+chartypes = loadYAML("SCAchars.yaml")
+
+##############################################################################
+
+# The shortest and longest lengths of text which each regexp passed to
+# getWidth() can match. Each rule asks about its own regexp more than
+# once, and parsing it is slow.
+widths = {}
+
+""" Return the shortest and longest lengths of text which the regexp
+_rexp_ can match. Like the re module, this remembers a limited number
+of them.
+"""
+
+def getWidth(rexp):
+    w = widths.get(rexp)
+
+    # Another thread may clear the dictionary at any time, so the width
+    # is returned from here rather than looked up again.
+    if w is None:
+        if len(widths) >= 1000: widths.clear()
+        w = widths[rexp] = sre_parse.parse(rexp).getwidth()
+
+    return w
+
+""" Return the shortest length of text which the regexp _rexp_ can
+match.
+"""
+
+def minWidth(rexp): return getWidth(rexp)[0]
+
+""" Return the longest length of text which the regexp _rexp_ can
+match, or None if there's no limit.
+"""
+
+def maxWidth(rexp):
+    n = getWidth(rexp)[1]
+
+    if n >= sre_constants.MAXREPEAT - 1: return None
+
+    return n
+
+""" Could the regexp _rexp_ look at text before or after what it
+matches, other than with '^' and '$'?
+"""
+
+def looksAround(rexp):
+    for s in "(?=", "(?!", "(?<", "\\b", "\\B", "\\A", "\\Z":
+        if s in rexp: return True
+
+    return False
+
+""" Could the regexp _rexp_ match a newline, or depend on where the
+text it searches starts or ends other than through '^' and '$'? If
+not, searching words joined by newlines with '^' and '$' in multi-line
+mode finds the same matches in each word as searching the word on its
+own; see SCARule.applyJoined().
+"""
+
+def crossesLines(rexp):
+    P = sre_parse.parse(rexp)
+
+    if P.pattern.flags & (sre_constants.SRE_FLAG_DOTALL |
+                          sre_constants.SRE_FLAG_MULTILINE):
+        return True
+
+    return crosses(P)
+
+""" Could the parsed regexp _P_ match a newline? See crossesLines().
+"""
+
+def crosses(P):
+    C = sre_constants
+
+    for op, av in P:
+        if op == C.LITERAL:
+            if av == 10: return True
+        elif op == C.NOT_LITERAL:
+            if av != 10: return True
+        elif op == C.IN:
+            for op2, av2 in av:
+                if op2 == C.NEGATE: return True
+                if op2 == C.LITERAL and av2 == 10: return True
+                if op2 == C.RANGE and av2[0] <= 10 <= av2[1]: return True
+                if op2 == C.CATEGORY and \
+                   av2 not in (C.CATEGORY_DIGIT, C.CATEGORY_WORD):
+                    return True
+        elif op == C.AT:
+            if av in (C.AT_BEGINNING_STRING, C.AT_END_STRING): return True
+        elif op == C.SUBPATTERN:
+            if crosses(av[1]): return True
+        elif op in (C.MAX_REPEAT, C.MIN_REPEAT):
+            if crosses(av[2]): return True
+        elif op == C.BRANCH:
+            for B in av[1]:
+                if crosses(B): return True
+        elif op in (C.ASSERT, C.ASSERT_NOT):
+            if crosses(av[1]): return True
+        elif op == C.GROUPREF_EXISTS:
+            for B in av[1:]:
+                if B is not None and crosses(B): return True
+        elif op not in (C.ANY, C.GROUPREF):
+            return True
+
+    return False
+
+##############################################################################
+
+""" The operations in the plans which SCAMatchingRulePart.makePlan()
+compiles AFTER into. Each step of a plan is a tuple of an operation and
+up to four arguments:
+LITERAL: add the text _a_
+GROUP:   add the text which matched PRE, BEFORE or POST, as _a_ is 0, 1
+         or 2
+COPY:    add the text which matched item _a_ in BEFORE
+CALL:    add the text which item _a_ in AFTER converts the text which
+         matched item _c_ in BEFORE to, using part _b_
+MAP:     as CALL, but look the text up in dictionary _d_ first; see
+         SCAVector.getTable()
+"""
+
+PLAN_LITERAL, PLAN_GROUP, PLAN_COPY, PLAN_CALL, PLAN_MAP = range(5)
 
 ##############################################################################
 
@@ -30,23 +151,34 @@ class SCARulePart:
 
         if len(s) == 0: return
 
-        L = list(s)
+        # How far through _s_ parsing has got.
+        self.pos = 0
 
-        while len(L) > 0: self.doNext(L)
+        while self.pos < len(s): self.doNext()
 
         self.addLast()
 
+    """ Return the next character of the string and move past it, or
+    return None if there isn't one.
+    """
+    def getNext(self):
+        if self.pos >= len(self.text): return None
+
+        self.pos += 1
+
+        return self.text[self.pos - 1]
+
     """ Do something with the next character in the string. """
-    def doNext(self, L):
-        c = L.pop(0)
+    def doNext(self):
+        c = self.getNext()
 
-        if c in chartypes:
-            H = chartypes[c]
+        if c in charfuncs:
+            f, H = charfuncs[c]
 
-            if not hasattr(self, "add_" + H["type"]):
+            if f is None:
                 raise SCAException("No add function for %s", H["type"])
 
-            getattr(self, "add_" + H["type"])(c, L, H)
+            f(self, c, H)
             return
 
         # Uppercase characters might refer to categories,
@@ -55,43 +187,50 @@ class SCARulePart:
             return
 
         if   self.parent.sca.hasDef("cat",  c):
-            self.add(SCACategory, c, self.getQuants(L))
+            self.add(SCACategory, c, self.getQuants())
         elif self.parent.sca.hasDef("list", c):
-            self.add(SCAList,     c, self.getQuants(L))
+            self.add(SCAList,     c, self.getQuants())
         else:
             self.last += c
 
-    """ Remove any quantifiers from the string, and return them. """
-    def getQuants(self, L):
-        s = ""
-        
-        while len(L) > 0 and L[0] in '*+?': s += L.pop(0)
+    """ Move past any quantifiers in the string, and return them. """
+    def getQuants(self):
+        i = self.pos
+
+        while self.pos < len(self.text) and self.text[self.pos] in '*+?':
+            self.pos += 1
 
-        return s
+        return self.text[i:self.pos]
 
-    """ Digits get converted to indexes. """
-    def add_index(self, c, L, H):
+    """ Digits get converted to indexes. A '-' which isn't followed by
+    one is just a '-'.
+    """
+    def add_index(self, c, H):
         sign = ''
 
-        if c == '-': sign, c = c, L.pop(0)
+        if c == '-':
+            sign = c
+            if self.pos < len(self.text): c = self.text[self.pos]
 
-        if c in "123456789": self.add(SCAIndex, sign + c)
+        if c in "123456789":
+            if sign: self.pos += 1
+            self.add(SCAIndex, sign + c)
         else:
-            L = [c] + L
             self.last += "-"
 
     """ Hash characters get turned into the appropriate regexp
     special character. """
-    def add_anchor(self, c, L, H):
+    def add_anchor(self, c, H):
         if not self.anchor:
             raise SCAException("'#' is not allowed in BEFORE " +
                                        "or AFTER ")
         self.last += self.anchor
 
     """ Backslashes escape the following character. """
-    def add_escape(self, c, L, H):
-        if len(L) == 0: c = ' '
-        else:           c = L.pop(0)
+    def add_escape(self, c, H):
+        c = self.getNext()
+
+        if c is None: c = ' '
 
         if c in '.|?+*<[{%#': c = '\\' + c
         elif c == '\\': c += c
@@ -99,30 +238,29 @@ class SCARulePart:
         self.last += c
 
     """ Some characters need to be escaped. """
-    def add_special(self, c, L, H): self.last += '\\' + c
+    def add_special(self, c, H): self.last += '\\' + c
 
     """ Add a zero. """
-    def add_zero(self, c, L, H): self.add(SCAZero, '')
+    def add_zero(self, c, H): self.add(SCAZero, '')
 
     """ Add a part reference to BEFORE. """
-    def add_part(self, c, L, H):
-        if len(L) > 0 and L[0] in '123':
-            self.items.append(SCAPartref(self.parent, 0, L.pop(0)))
+    def add_part(self, c, H):
+        if self.pos < len(self.text) and self.text[self.pos] in '123':
+            self.items.append(SCAPartref(self.parent, 0, self.getNext()))
         else:
             self.items.append(SCAPartref(self.parent, 0, "1"))
 
     """ Add a delimited item. """
-    def add_delim(self, c, L, H):
-        s, d = "", H['close']
-
-        if d not in L: raise SCAException("No terminator '%s' found", d)
+    def add_delim(self, c, H):
+        d = H['close']
+        i = self.text.find(d, self.pos)
 
-        while L[0] != d: s += L.pop(0)
+        if i < 0: raise SCAException("No terminator '%s' found", d)
 
-        L.pop(0)
-        quants = self.getQuants(L)
+        s, self.pos = self.text[self.pos:i], i + 1
+        quants = self.getQuants()
 
-        self.add(globals()["SCA" + H['class']], s, quants)
+        self.add(charclasses[c], s, quants)
 
     """ Add any leftover text as a single literal. """
     def addLast(self):
@@ -154,6 +292,64 @@ class SCARulePart:
     def getRexp(self): return self.get("getRexp")
     def getText(self): return self.get("getText")
 
+    """ Can the regexp for this part contain a '^' anchor? Categories
+    and features use '^' only for complementation.
+    """
+    def hasCaret(self):
+        for I in self.items:
+            if isinstance(I, (SCACategory, SCAFeature)): continue
+            if "^" in I.getRexp(): return True
+
+        return False
+
+    """ Could a literal or string in this part contain a '|' which
+    isn't inside a group? If so, it applies to the rest of the part,
+    and the items can't be matched one by one.
+    """
+    def hasAlternation(self):
+        for I in self.items:
+            if isinstance(I, (SCALiteral, SCAString)) and hasBar(I.rexp):
+                return True
+
+        return False
+
+    """ Must text matching this part start at the start of the word,
+    i.e. does it start with '#'?
+    """
+    def isInitial(self):
+        if len(self.items) == 0 or self.hasAlternation(): return False
+
+        I = self.items[0]
+
+        return isinstance(I, SCALiteral) and I.rexp[:1] == '^'
+
+    """ Must text matching this part end at the end of the word, i.e.
+    does it end with '#'? A '\\' before a '$' may itself be escaped.
+    """
+    def isFinal(self):
+        if len(self.items) == 0 or self.hasAlternation(): return False
+
+        I = self.items[-1]
+
+        if not isinstance(I, SCALiteral) or I.rexp[-1:] != '$': return False
+
+        s = I.rexp[:-1]
+
+        return (len(s) - len(s.rstrip('\\'))) % 2 == 0
+
+    """ Return the strings which text matching this part must
+    contain; see SCAItem.getNeeds().
+    """
+    def getNeeds(self):
+        L = []
+
+        for I in self.items:
+            N = I.getNeeds()
+            if N is None: return []
+            L += N
+
+        return L
+
     """ Debugging function. """
     def showDetailed(self, header):
         print header
@@ -183,60 +379,147 @@ class SCARulePart:
 
         return "".join([self.colourChar(c) for c in s])
 
+""" The method of SCARulePart which handles each special character,
+or None if there isn't one, and its details from SCAchars.yaml; see
+SCARulePart.doNext(). For the characters which start delimited items,
+the class of the item; see SCARulePart.add_delim().
+"""
+
+charfuncs, charclasses = {}, {}
+
+for c, H in chartypes.items():
+    charfuncs[c] = getattr(SCARulePart, "add_" + H["type"], None), H
+
+    if "class" in H: charclasses[c] = globals()["SCA" + H["class"]]
+
+##############################################################################
+
 """ This class is used for BEFORE and AFTER, which require more
 functionality than PRE and POST. """
 
 class SCAMatchingRulePart(SCARulePart):
-    """ We need a special regexp to identify each item in BEFORE. """
+    """ We need a special regexp to identify each item in BEFORE; see
+    getItemRe().
+    """
     def __init__(self, parent, s, before):
         SCARulePart.__init__(self, parent, None, s, before)
 
         self.re = None
 
-        if before:
-            rexp = "".join(["(%s)" % I.getRexp() for I in self.items])
-            self.re = re.compile(rexp)
+    """ Return the regexp which matches each item in BEFORE in a group
+    of its own. It's only compiled when it's first needed, since most
+    rules' own regexps say what each item matched; see convert().
+    """
+    def getItemRe(self):
+        if self.re is None:
+            self.re = re.compile("".join(["(%s)" % I.getRexp()
+                                          for I in self.items]))
+
+        return self.re
+
+    """ Compile this part, which must be AFTER, into a plan (see
+    PLAN_LITERAL above), so that convert() needn't work out what each
+    item does each time the rule matches. Items are looked at as in
+    convertItem(), and items in BEFORE are numbered as in its regexp.
+    """
+    def makePlan(self):
+        p, L = self.parent, []
+        k = len(p.before)
+
+        for I in self.items:
+            if not I.indexable():
+                t = I.convert(None, None, None, None)
+
+                if len(L) > 0 and L[-1][0] == PLAN_LITERAL:
+                    L[-1] = (PLAN_LITERAL, L[-1][1] + t)
+                else:
+                    L.append((PLAN_LITERAL, t))
+
+                continue
+
+            if I.group is not None:
+                L.append((PLAN_GROUP, I.group - 1))
+                continue
+
+            n = I.getRef()
+
+            if n < 0: n += k
+            else:     n -= 1
+
+            R = p.getPart(I.part)
+            T = None
+
+            # Anything starting with '$' still needs evaluated.
+            if isinstance(I, SCAVector):
+                T = I.getTable(R)
+
+                if T is not None:
+                    for t in T.values():
+                        if t[:1] == '$': T = None; break
+
+            if isinstance(I, SCAIndex):
+                L.append((PLAN_COPY, n))
+            elif T is not None:
+                L.append((PLAN_MAP, I, R, n, T))
+            else:
+                L.append((PLAN_CALL, I, R, n))
+
+        self.plan = L
+
+        # Most AFTERs are just text.
+        self.const = None
+
+        if len(L) == 0: self.const = ""
+        elif len(L) == 1 and L[0][0] == PLAN_LITERAL: self.const = L[0][1]
 
     """ Convert the text which matches to a single item.
     R: the corresponding item in AFTER
     I: the item in BEFORE
-    m: the matchitem which matched BEFORE
-    groups: the matchitem which matched PRE-BEFORE-POST
+    items: the text which matched each item in BEFORE
+    groups: the text which matched PRE, BEFORE, and POST
     verbose: for debugging
     """
-    def convertItem(self, R, I, m, groups, verbose):
+    def convertItem(self, R, I, items, groups, verbose):
         if not I.indexable(): return I.convert(None, None, None, None)
 
         if I.group is not None: return groups[I.group - 1]
 
         n = I.getRef()
 
-        if n < 0: n += m.lastindex
+        if n < 0: n += len(items)
         else:     n -= 1
 
-        if len(m.groups()) > 0:
-            old = m.groups()[n]
+        if len(items) > 0:
+            old = items[n]
         else:
             old = ""
 
         if verbose: print cols(old, 33)
 
-        s = I.convert(R, old, groups, m.groups())
+        s = I.convert(R, old, groups, items)
         return self.parent.sca.evaluate(s)
 
     """ We've matched something, so we need to do the replacements.
     p: the rule of which this part is a part
-    orig: the matchitem which matched PRE-BEFORE-POST
+    groups: the text which matched PRE, BEFORE, and POST
+    items: the text which matched each item in BEFORE, or None if the
+    rule's regexp doesn't say, in which case BEFORE is matched again
     verbose: for debugging
     """
-    def convert(self, p, orig, verbose = False):
-        s = orig.groups(1)[1] # this is what matched to BEFORE
-        m = p.before.re.match(s)
+    def convert(self, p, groups, items, verbose = False):
+        if self.const is not None and not verbose: return self.const
+
+        if items is None:
+            m = p.before.getItemRe().match(groups[1])
+            if m is not None: items = m.groups()
+
+        if not verbose: return self.follow(groups, items)
+
         ret = ""
 
         if verbose:
-            print "regexp matched", orig.groups()
-            print "BEFORE matched", m.groups()
+            print "regexp matched", groups
+            print "BEFORE matched", items
             print
 
         for i, I in enumerate(self.items):
@@ -246,7 +529,7 @@ class SCAMatchingRulePart(SCARulePart):
                 print cols(I, 43)
                 R.showDetailed("--------")
 
-            t = self.convertItem(R, I, m, orig.groups(), verbose)
+            t = self.convertItem(R, I, items, groups, verbose)
 
             if verbose:
                 print "-> [" + t + "] <-"
@@ -256,6 +539,31 @@ class SCAMatchingRulePart(SCARulePart):
 
         return ret
 
+    """ Do what convert() does by following the plan. """
+    def follow(self, groups, items):
+        L, evaluate = [], self.parent.sca.evaluate
+
+        for T in self.plan:
+            op = T[0]
+
+            if op == PLAN_LITERAL:
+                L.append(T[1])
+            elif op == PLAN_GROUP:
+                L.append(groups[T[1]])
+            elif op == PLAN_MAP and items[T[3]] in T[4]:
+                L.append(T[4][items[T[3]]])
+            else:
+                if op == PLAN_COPY: s = items[T[1]]
+                else:               s = T[1].convert(T[2], items[T[3]],
+                                                     groups, items)
+
+                # Strings are the only things evaluate() changes.
+                if s[:1] == '$': s = evaluate(s)
+
+                L.append(s)
+
+        return "".join(L)
+
 ##############################################################################
 
 """ This class encapsulates a single rule.
@@ -342,8 +650,35 @@ class SCARule:
         self.before = SCAMatchingRulePart(self, before, True)
         self.after  = SCAMatchingRulePart(self, after,  False)
 
-        self.rexp = "".join(["(%s)" % P.getExtRexp()
-                            for P in self.pre, self.before, self.post])
+        # Each item in BEFORE gets a group of its own inside the group
+        # for BEFORE, unless a '|' would then apply to just one item.
+        # POST's group comes after all of them.
+        self.nested = len(self.before) < 2 or \
+                      not self.before.hasAlternation()
+
+        if self.nested: self.postgroup = len(self.before) + 3
+        else:           self.postgroup = 3
+
+        for P in self.pre, self.before, self.post:
+            for I in P.items:
+                if isinstance(I, SCAPartref) and I.group == 3:
+                    I.extrexp = "\\%d" % self.postgroup
+
+        # Part references have never matched anything by themselves,
+        # so their groups stay empty.
+        if self.nested:
+            L = []
+
+            for I in self.before.items:
+                if isinstance(I, SCAPartref): L.append(I.getExtRexp() + "()")
+                else: L.append("(%s)" % I.getExtRexp())
+
+            before = "".join(L)
+        else:
+            before = self.before.getExtRexp()
+
+        self.rexp = "(%s)(%s)(%s)" % (self.pre.getExtRexp(), before,
+                                      self.post.getExtRexp())
 
         if verbose:
             for i in ["before", "after", "pre", "post"]:
@@ -352,10 +687,70 @@ class SCARule:
 
         for I in self.after: I.validate(verbose)
 
+        self.after.makePlan()
+
         self.parts = (self.before, self.after, self.pre, self.post)
 
         self.re = re.compile(self.rexp)
 
+        # True if the rule's regexp can contain '^'.
+        self.caret = self.pre.hasCaret() or self.before.hasCaret()
+
+        # The longest text the rule can match, or None if there's no
+        # limit or it can't be known: part references make widths
+        # meaningless, and regexps in strings may look beyond what
+        # they match.
+        self.maxwidth = None
+
+        if not self.hasPartrefs() and not looksAround(self.rexp):
+            self.maxwidth = maxWidth(self.rexp)
+
+        # True if the rule can match only at the start or only at the
+        # end of the word, so that applyForward() and applyReverse()
+        # needn't try everywhere.
+        self.initial = self.pre.isInitial()
+        self.final = self.post.isFinal() and self.maxwidth is not None
+
+        # Strings which the word must contain for the rule to match;
+        # see canMatch().
+        self.needs = []
+
+        for P in self.pre, self.before, self.post:
+            for T in P.getNeeds():
+                if T not in self.needs: self.needs.append(T)
+
+        # How apply() applies the rule, and what it needs to do so;
+        # see classify().
+        self.kind, self.fast = self.classify()
+
+        # Whether the rule uses random numbers, and where it gets them
+        # from; see apply().
+        self.random, self.rng = self.isRandom(), self.sca.rng
+
+        # Whether applyJoined() can apply the rule, and the regexp it
+        # uses, or None until it's needed; see canJoin().
+        self.joined = None
+
+    """ Does PRE, BEFORE, or POST contain a part reference? """
+    def hasPartrefs(self):
+        for P in self.pre, self.before, self.post:
+            for I in P.items:
+                if isinstance(I, SCAPartref): return True
+
+        return False
+
+    """ Split the groups _G_ matched by this rule's regexp, starting
+    at index _i_, into a tuple of the text which matched PRE, BEFORE,
+    and POST and one of the text which matched each item in BEFORE, if
+    known; see SCAMatchingRulePart.convert().
+    """
+    def split(self, G, i = 0):
+        n = i + self.postgroup - 1
+
+        if self.nested: return (G[i], G[i + 1], G[n]), G[i + 2:n]
+
+        return (G[i], G[i + 1], G[n]), None
+
     """ Interpret the flag strings. """ 
     def makeFlags(self, L):
         self.percent, self.banana, self.reverse, self.once, \
@@ -439,42 +834,301 @@ class SCARule:
         if E is not None and E.isException(self.name, word, d):
             return 2, word
 
-        if self.reverse: n, dn = len(word) - 1, -1
-        else:            n, dn = False, 0
+        # Each word gets its own random numbers for each rule when
+        # seeding by word; see SCA.getRandom().
+        if self.random:
+            self.rng = self.sca.getRandom((self.file, self.line), word)
 
-        w = word
+            if self.percent is not None and \
+               self.rng.randint(0, 99) >= self.percent:
+                return 0, word
+
+        if self.kind != "general" and not verbose:
+            if self.kind == "sub": return 0, self.re.sub(self.fast, word)
+
+            if self.kind == "replace":
+                if isinstance(word, unicode) == \
+                   isinstance(self.fast[0], unicode):
+                    return 0, word.replace(*self.fast)
+            elif isinstance(word, unicode):
+                return 0, word.translate(self.fast)
+
+        if self.needs and not self.canMatch(word):
+            if verbose: print "Cannot match:", word
+            return 0, word
 
         if verbose: print "Looking for:", self.re.pattern
 
+        if self.reverse: return 0, self.applyReverse(word, verbose)
+
+        return 0, self.applyForward(word, verbose)
+
+    """ Return False if _word_ lacks something which every match
+    needs, so that the rule can't possibly apply to it.
+    """
+    def canMatch(self, word):
+        try:
+            for T in self.needs:
+                for s in T:
+                    if s in word: break
+                else:
+                    return False
+        except UnicodeDecodeError:
+            pass
+
+        return True
+
+    """ If this rule replaces single characters whatever their context,
+    applying it is the same as replacing each character on its own.
+    In that case, return a dictionary which maps each character which
+    the rule changes to its replacement; otherwise return None.
+    """
+    def getCharMap(self):
+        if self.once or self.reverse or self.isRandom(): return None
+
+        if len(self.pre) > 0 or len(self.post) > 0: return None
+
+        if len(self.before) != 1: return None
+
+        chars = self.before[1].getChars()
+
+        if chars is None: return None
+
+        H = {}
+
+        try:
+            for c in chars:
+                t = self.applyForward(c)
+                if t != c: H[c] = t
+        except Exception:
+            return None # leave the error to the unoptimised rule
+
+        return H
+
+    """ Work out whether apply() can use something faster than
+    applyForward() for this rule, which it can if the environment is
+    empty and the rule has no flags which change how it's applied.
+    Return a tuple of the kind of rule and what apply() needs:
+    - ("replace", (BEFORE, AFTER)) for str.replace() if BEFORE and
+      AFTER are both fixed text
+    - ("translate", table) for unicode.translate() if BEFORE is a
+      single character from a fixed set; see getCharMap()
+    - ("sub", AFTER) for re.sub() if AFTER is fixed text
+    - ("general", None) otherwise
+    """
+    def classify(self):
+        if self.once or self.reverse or self.caret: return "general", None
+
+        if len(self.pre) > 0 or len(self.post) > 0: return "general", None
+
+        if minWidth(self.rexp) == 0: return "general", None
+
+        t = self.after.const
+
+        if len(self.before) == 1:
+            s = self.before[1].getLiteral()
+
+            if s is not None and t is not None: return "replace", (s, t)
+
+            H = self.getCharMap()
+
+            if H is not None:
+                try:
+                    return "translate", dict([(ord(unicode(c)), unicode(r))
+                                              for c, r in H.items()])
+                except UnicodeDecodeError:
+                    pass
+
+        if t is None: return "general", None
+
+        # re.sub() reads the replacement as a template, so any '\\'
+        # has to be escaped.
+        return "sub", t.replace('\\', '\\\\')
+
+    """ Apply this rule to _word_ from left to right. Since PRE is
+    part of each match, everything from the current position onwards
+    is still the original word, so we can search the original word
+    once and join the pieces at the end instead of rebuilding the
+    word after every match.
+    """
+    def applyForward(self, word, verbose = False):
+        L, n, last, size, out = [], 0, 0, len(word), False
+
+        while True:
+            # If everything so far has been deleted, '#' in PRE can
+            # match again at what is now the start of the word.
+            if self.caret and n > 0 and not out:
+                m, base = self.re.match(self.window(word, n, size)), n
+                if m is None:
+                    n, out = n + 1, True
+                    if n >= size: break
+                    continue
+            elif self.initial:
+                if n > 0: break
+                m, base = self.re.match(word), 0
+            elif self.final:
+                # '$' also matches before a final newline.
+                i = max(n, size - self.maxwidth - 1)
+                m, base = self.re.search(word, i), 0
+            else:
+                m, base = self.re.search(word, n), 0
+
+            if verbose: print "Matched:", word, n, m
+
+            if m is None: break
+
+            s = base + m.start()
+
+            if s >= size and s > 0: break
+
+            groups, items = self.split(m.groups())
+            pre, before, post = groups
+            t = self.after.convert(self, groups, items, verbose)
+
+            if self.banana: e, t = base + m.end(2), pre + t
+            else:           e, t = base + m.end(),  pre + t + post
+
+            L.append(word[last:s])
+            L.append(t)
+            out = out or s > last or len(t) > 0
+
+            # An empty match must still move us on.
+            last, n = e, max(e, s + 1)
+
+            if self.once or n >= size: break
+
+        L.append(word[last:])
+
+        return "".join(L)
+
+    """ Apply this rule to _word_ from right to left. Here later
+    matches can see the results of earlier ones, so the word has to be
+    rebuilt after each match.
+    """
+    def applyReverse(self, word, verbose = False):
+        if self.maxwidth is not None and not verbose:
+            return self.applyReverseInChunks(word)
+
+        n, w = len(word) - 1, word
+
+        # '^' can only match at 0.
+        if self.initial: n = min(n, 0)
+
         while True:
+            # Nothing nearer the start can match, so we're done.
+            if self.final and n < len(w) - self.maxwidth - 1: break
+
             m = self.re.match(w, n)
             if verbose: print "Matched:", w, n, m
 
             if m is not None:
-                pre, before, post = m.groups()
+                groups, items = self.split(m.groups())
+                pre, before, post = groups
                 e = m.end()
-                t = self.after.convert(self, m, verbose)
+                t = self.after.convert(self, groups, items, verbose)
                 w = w[:n] + pre + t + post + w[e:]
 
-                if not self.reverse:
-                    dn = len(pre) + len(t)
-                    if not self.banana: dn += len(post)
-            elif not self.reverse: dn = 1
+            n -= 1
+
+            if n < 0: break
+
+            if self.once and m: break
+
+        return w
+
+    """ Return enough of _word_ from position _n_ for a match of this
+    rule to be found there as if the word started at _n_; _size_ is
+    the length of the word. Two characters more than the longest match
+    stop '$' matching where the text is cut off.
+    """
+    def window(self, word, n, size):
+        if self.maxwidth is None or n + self.maxwidth + 2 >= size:
+            return word[n:]
+
+        return word[n:n + self.maxwidth + 2]
+
+    """ Do what applyReverse() does for a rule whose matches have a
+    limited width, in time proportional to the length of _word_.
+    Everything before position _n_ is still the original word. The
+    rest is the original word up to _k_, followed by the chunks of
+    text in _S_, each a tuple of a string and a start and end index
+    into it, with the first chunk last. Each match only needs to look
+    at the first few characters of the rest of the word, and only
+    changes the chunks near the top of _S_.
+    """
+    def applyReverseInChunks(self, word):
+        n, k, S, size = len(word) - 1, len(word), [], 0
+        W = self.maxwidth + 2 # see window()
+
+        if self.initial: n = min(n, 0)
+
+        while True:
+            if self.final and n < k + size - self.maxwidth - 1: break
+
+            # A character before _n_ stops '^' matching there.
+            i = max(n - 1, 0)
+            s = word[i:min(k, n + W)]
+
+            if n + W > k:
+                L, j = [s], n + W - k
 
-            n += dn
+                for T in reversed(S):
+                    L.append(T[0][T[1]:min(T[2], T[1] + j)])
+                    j -= T[2] - T[1]
+                    if j <= 0: break
 
-            if self.reverse and n < 0: break
-            if not self.reverse and n >= len(w): break
+                s = "".join(L)
+
+            m = self.re.match(s, n - i)
+
+            if m is not None:
+                groups, items = self.split(m.groups())
+                pre, before, post = groups
+                t = pre + self.after.convert(self, groups, items) + post
+                e = i + m.end()
+
+                if e <= k:
+                    if e < k: S.append((word, e, k))
+                    size += k - e
+                else:
+                    # Take the rest of the match off the chunks.
+                    size, j = size - (e - k), e - k
+
+                    while j > 0:
+                        s, a, b = S.pop()
+
+                        if b - a > j:
+                            S.append((s, a + j, b))
+                            break
+
+                        j -= b - a
+
+                if len(t) > 0: S.append((t, 0, len(t)))
+
+                k, size = max(n, 0), size + len(t)
+
+            n -= 1
+
+            if n < 0: break
 
             if self.once and m: break
 
-        return 0, w
+        return word[:k] + "".join([u[p:q] for u, p, q in reversed(S)])
 
     """ Add an assertion to this rule. The parameters must be, in
     order, the dialect, the word, and the expected result.
     """
     def addAssertion(self, *args): self.assertions.append(args)
 
+    """ Does this rule use random numbers? """
+    def isRandom(self):
+        if self.percent is not None: return True
+
+        for I in self.after.items:
+            if I.random: return True
+
+        return False
+
     """ Apply this rule to some words.
     H: should map dialects to words
     E: exceptions
@@ -498,18 +1152,163 @@ class SCARule:
                 if ret != r:
                     raise SCAException(f, self.line, self.file, r, ret)
 
+        # Dialects which hold the same word get the same result, unless
+        # the rule uses random numbers which aren't seeded by the word,
+        # so apply it once to each different word.
+        done = {}
+        share = self.sca.lastword is not None or not self.random
+        func = extras.get("func")
+
+        if E is not None and not E.has(self.name): E = None
+
         for d in H.keys():
             oldword = H[d]
 
-            self.sca.setLastWord(oldword)
-
-            ret, newword = self.apply(d, oldword, E)
+            if share and oldword in done and self.appropriate(d) and \
+               (E is None or not E.isException(self.name, oldword, d)):
+                ret, newword = 0, done[oldword]
+            else:
+                ret, newword = self.apply(d, oldword, E)
+                if ret == 0: done[oldword] = newword
 
-            if "func" in extras and extras["func"] is not None:
-                extras["func"](self, d, ret, oldword, newword, P is None)
+            if func is not None:
+                func(self, d, ret, oldword, newword, P is None)
 
             H[d] = newword
 
+    """ Apply this rule to the words in _L_, a list of SCAWord, as
+    process() would to each in turn; see SCARuleGroup.processMany().
+    If the rule can be applied to all the words at once (see
+    applyJoined()), each different word is only looked at once.
+    E: exceptions
+    """
+    def processMany(self, L, E):
+        if E is not None and not E.has(self.name): E = None
+
+        if len(L) == 0: return
+
+        if not self.canJoin():
+            for W in L: self.process(W.H, E, None)
+            return
+
+        # The dialects to which the rule applies, and each different
+        # word in them which isn't an exception.
+        D = [ d for d in L[0].H.keys() if self.appropriate(d) ]
+        words = set()
+
+        for W in L:
+            for d in D:
+                w = W.H[d]
+                if E is None or not E.isException(self.name, w, d):
+                    words.add(w)
+
+        if len(words) == 0: return
+
+        words = list(words)
+
+        for w in words:
+            if not isinstance(w, unicode) or "\n" in w:
+                for W in L: self.process(W.H, E, None)
+                return
+
+        M = dict(zip(words, self.applyJoined(words)))
+
+        for W in L:
+            for d in D:
+                w = W.H[d]
+                if E is None or not E.isException(self.name, w, d):
+                    W.H[d] = M[w]
+
+    """ Can applyJoined() apply this rule? It can if the rule doesn't
+    use random numbers, is applied from left to right, and its regexp
+    can't match across the end of a word; see crossesLines().
+    """
+    def canJoin(self):
+        if self.joined is None:
+            self.joined = False
+
+            if self.random or self.reverse: pass
+            elif self.kind == "translate": self.joined = True
+            elif not crossesLines(self.rexp):
+                self.joined = re.compile(self.rexp, re.M)
+
+        return self.joined is not False
+
+    """ Return what apply() returns for each of _words_, which must all
+    be unicode and not contain newlines, from a single pass over them
+    joined by newlines, with '^' and '$' matching at the start and end
+    of each word. See canJoin().
+    """
+    def applyJoined(self, words):
+        text = u"\n".join(words)
+
+        if self.kind == "translate":
+            L = text.translate(self.fast).split(u"\n")
+        elif self.kind == "replace" and isinstance(self.fast[0], unicode):
+            L = text.replace(*self.fast).split(u"\n")
+        elif self.kind == "sub":
+            L = self.joined.sub(self.fast, text).split(u"\n")
+        else:
+            return self.applyForwardJoined(text, words)
+
+        # Just in case AFTER made a newline.
+        if len(L) != len(words): L = [ self.applyForward(w) for w in words ]
+
+        return L
+
+    """ Do what applyForward() does to each of _words_, as joined in
+    _text_. Searching _text_ finds the next match in whichever word
+    has one, so words without one cost nothing, and a match found
+    beyond the end of one word is kept for the next.
+    """
+    def applyForwardJoined(self, text, words):
+        R, a, m, end = [], 0, None, False
+
+        for word in words:
+            L, b, out = [], a + len(word), False
+            n = last = a
+
+            while not end:
+                # If everything so far has been deleted, '#' in PRE can
+                # match again, which applyForward() sees to.
+                if self.caret and n > a and not out: L = None; break
+
+                if self.initial and n > a: break
+
+                if m is None or m.start() < n:
+                    m = self.joined.search(text, n)
+                    if m is None: end = True; break
+
+                s = m.start()
+
+                if s >= b and s > a: break
+
+                groups, items = self.split(m.groups())
+                pre, before, post = groups
+                t = self.after.convert(self, groups, items)
+
+                if self.banana: e, t = m.end(2), pre + t
+                else:           e, t = m.end(),  pre + t + post
+
+                L.append(text[last:s])
+                L.append(t)
+                out = out or s > last or len(t) > 0
+
+                # An empty match must still move us on.
+                last, n, m = e, max(e, s + 1), None
+
+                if self.once or n >= b: break
+
+            if L is None:
+                R.append(self.applyForward(word))
+            else:
+                L.append(text[last:b])
+                R.append("".join(L))
+
+            a = b + 1
+
+        return R
+
     """ Return the rule in text form.
     b: True to return it like the input, False as a regexp
     c: True to colour it, False if not
@@ -540,11 +1339,14 @@ class SCAHeading:
     """
     def __init__(self, level, text):
         self.level, self.text = level, text
+        self.kind = "heading"
 
     def process(self, H, E, P, **extras):
         if "func" in extras and extras["func"] is not None:
             extras["func"](self, None, self.level, self.text, None, True)
 
+    def isRandom(self): return False
+
 ##############################################################################
 
 """ Parameters for groups. The keys are the names of the parameters;
@@ -639,6 +1441,33 @@ class SCAGroupParams(dict):
 
 ##############################################################################
 
+""" What SCARuleGroup.processMany() keeps for each word: the word in
+each dialect, and what the SCA instance keeps for the word which is
+being processed.
+"""
+
+class SCAWord:
+    """ The constructor.
+    sca: the SCA instance
+    word: the word
+    dialects: the dialects to process it in
+    """
+    def __init__(self, sca, word, dialects):
+        self.sca, self.word = sca, word
+        self.H = dict([ (d, word) for d in dialects ])
+        self.streams, self.fixed = {}, {}
+
+    """ Make this the word which is being processed. """
+    def use(self):
+        S = self.sca
+
+        if S.lastword is not None:
+            S.lastword, S.streams = self.word, self.streams
+
+        S.persistent.fixed = self.fixed
+
+##############################################################################
+
 """ A class which represents groups of rules. """
 
 class SCARuleGroup:
@@ -656,6 +1485,14 @@ class SCARuleGroup:
         self.params = SCAGroupParams(GroupParams, params, H)
         self.name   = self.params["name"]
 
+        # Where this group is among the groups, for SCA.getRandom().
+        self.path   = ()
+        if parent is not None: self.path = parent.path + (len(parent.rules),)
+
+        # For the persistent rules, the word in each dialect which
+        # they're known to leave unchanged; see settle().
+        self.fixed  = {}
+
         if self.params["pick"] is not None:
             self.params["shuffle"] = True
             self.params["max"] = self.params["pick"]
@@ -679,7 +1516,7 @@ class SCARuleGroup:
     """
     def proceed(self, param):
         n = self.params[param]
-        b = n is None or random.randint(0, 99) < n
+        b = n is None or self.rng.randint(0, 99) < n
         r = self.params["reduce"]
 
         if r is not None and n is not None:
@@ -696,22 +1533,137 @@ class SCARuleGroup:
     other arguments: see SCARule.process()
     """
     def process(self, H, E, P, **extras):
-        n, m = 0, self.params["max"]
+        n, m, L = 0, self.params["max"], self.rules[:]
+        self.rng = self.sca.getRandom(self.path)
 
         for i in range(self.params["times"]):
             if not self.proceed("prob"): continue
 
-            if self.params["shuffle"]: random.shuffle(self.rules)
+            if self.params["shuffle"]: self.rng.shuffle(L)
 
-            for R in self.rules:
+            for R in L:
                 if not self.proceed("ruleprob"): continue
 
                 R.process(H, E, P, **extras)
-                if P is not None: P.process(H, E, None, **extras)
+                if P is not None: P.settle(H, E, **extras)
 
                 n += 1
                 if m and n >= m: break
 
+    """ Apply the rules in this group to several words, each rule to
+    all of them before the next, which does the same as process() on
+    each in turn as long as what happens to one word doesn't depend on
+    what happened to another; see SCA.process_many(). A group whose
+    parameters use random numbers is applied one word at a time, with
+    each word's own random numbers.
+    L: an SCAWord for each word
+    E, P: see process()
+    """
+    def processMany(self, L, E, P):
+        if self.hasRandomParams():
+            for W in L:
+                W.use()
+                self.process(W.H, E, P)
+
+            return
+
+        # The persistent rules and the random numbers for each word are
+        # only needed if there are any.
+        use = self.sca.lastword is not None or len(P.rules) > 0
+
+        n, m = 0, self.params["max"]
+
+        for i in range(self.params["times"]):
+            for R in self.rules:
+                if isinstance(R, SCARuleGroup):
+                    R.processMany(L, E, P)
+
+                    if use:
+                        for W in L:
+                            W.use()
+                            P.settle(W.H, E)
+                elif isinstance(R, SCARule):
+                    R.processMany(L, E)
+
+                    if use:
+                        for W in L:
+                            W.use()
+                            P.settle(W.H, E)
+                elif use:
+                    for W in L:
+                        W.use()
+                        R.process(W.H, E, P)
+                        P.settle(W.H, E)
+                else:
+                    for W in L: R.process(W.H, E, P)
+
+                n += 1
+                if m and n >= m: break
+
+    """ Apply the rules in this group, which should be the persistent
+    rules, to the words in _H_ after some other rule has been applied.
+    Words which they've already left unchanged would stay unchanged,
+    so they're skipped if the rules always do the same thing to the
+    same word; see SCA.canSkipPersistent().
+    other arguments: see SCARule.process()
+    """
+    def settle(self, H, E, **extras):
+        if extras.get("func") is not None or extras.get("doassert") or \
+           not self.sca.canSkipPersistent():
+            self.process(H, E, None, **extras)
+            return
+
+        D = dict([(d, w) for d, w in H.items() if self.fixed.get(d) != w])
+
+        if len(D) == 0: return
+
+        self.process(D, E, None, **extras)
+
+        for d, w in D.items():
+            if w == H[d]: self.fixed[d] = w
+            H[d] = w
+
+    """ Do this group's parameters, or those of any group inside it,
+    use random numbers?
+    """
+    def hasRandomParams(self):
+        P = self.params
+
+        if P["shuffle"] or P["prob"] is not None or P["ruleprob"] is not None:
+            return True
+
+        for R in self.rules:
+            if isinstance(R, SCARuleGroup) and R.hasRandomParams():
+                return True
+
+        return False
+
+    """ Does anything in this group use random numbers? """
+    def isRandom(self):
+        if self.hasRandomParams(): return True
+
+        for R in self.rules:
+            if R.isRandom(): return True
+
+        return False
+
+    """ Do the parameters of this group, or of any group inside it,
+    change as it's used, so that what it does to a word depends on
+    what it's done before? See proceed().
+    """
+    def changesParams(self):
+        P = self.params
+
+        if P["reduce"] is not None and \
+           (P["prob"] is not None or P["ruleprob"] is not None):
+            return True
+
+        for R in self.rules:
+            if isinstance(R, SCARuleGroup) and R.changesParams():
+                return True
+
+        return False
+
     """ Add a heading containing _text_ at _level_. """
     def addHeading(self, level, text):
         H = SCAHeading(level, text)
@@ -723,12 +1675,19 @@ class SCARuleGroup:
     """
     def addAssertion(self, *args): self.rules[-1].addAssertion(args)
 
-    """ Show all rules in this group; for debugging only.
+    """ Show all rules in this group, and how each is applied (see
+    SCARule.classify()); for debugging only.
     enc: the encoding to use
     """
     def showRules(self, enc):
         print "*** Group %s ***" % self.name
 
-        for R in self.rules: print R.text.encode(enc)
+        for R in self.rules:
+            if isinstance(R, SCARuleGroup):
+                R.showRules(enc)
+                continue
+
+            for s in R.text.split("\n"):
+                print ("%-10s %s" % (R.kind, s)).encode(enc)
 
 ##############################################################################
@@ -0,0 +1,298 @@
+# This file is part of Geoff's Sound Change Applier, version 0.8
+# (August 2010). You can obtain the latest version of this program
+# from http://gesc19764.pwp.blueyonder.co.uk/sca.html
+
+""" A server which keeps rules loaded, so that programs which process
+words through them often needn't start SCA and compile the rules each
+time. It listens on a Unix socket, or on a port on this machine only,
+and talks in lines of JSON: each request is one line, and so is each
+response. A request to process words looks like this:
+
+    {"rules": "spanish", "defs": {"times": "2"}, "words": ["lupum"]}
+
+"rules" is the sound-change file, relative to where the server was
+started; "defs" are the variables which would be given with '-D', and
+"exceptions" is a file of exceptions, as with '-x'; "dialects" are
+the dialects to use, which are all of them by default. Only "rules"
+and "words" are needed. The response has the results for each word in
+each dialect, in the same order as the words:
+
+    {"results": [{"S": "lobo"}]}
+
+The rules for each different set of "rules", "defs", and "exceptions"
+are compiled when they're first asked for, and compiled again when any
+file they were read from changes. The request {"stats": true} gets
+what the server has done so far, for each set of rules as well. If
+anything goes wrong, the response is {"error": "..."}.
+"""
+
+from SCA import *
+
+import SocketServer, json, optparse, os, signal, sys, threading, time
+
+##############################################################################
+
+""" A set of rules loaded in the server, which is read again when any
+of the files it was read from changes.
+"""
+
+class SCAServerRules:
+    """ The constructor.
+    key: the sound-change file, the variables as sorted (name, value)
+    pairs, and the exceptions file or None
+    opts: the server's options
+    """
+    def __init__(self, key, opts):
+        self.key, self.opts = key, opts
+        self.sca, self.times, self.error = None, None, None
+        self.checked, self.loads, self.requests, self.words = 0, 0, 0, 0
+
+        # Only one thread at a time can use an SCA instance.
+        self.lock = threading.Lock()
+
+    """ Return the modification times of the files in _L_, or None for
+    any which can't be found.
+    """
+    def getTimes(self, L):
+        T = {}
+
+        for f in L:
+            try:
+                T[f] = os.path.getmtime(f)
+            except OSError:
+                T[f] = None
+
+        return T
+
+    """ Compile the rules if they haven't been, or if any of the files
+    they were read from has changed, which is checked at most once every
+    '-i' seconds. If they can't be compiled, the error is kept until
+    the files change again, and the last rules which could be aren't
+    used.
+    """
+    def load(self):
+        if self.times is not None and \
+           time.time() - self.checked < self.opts.interval:
+            return
+
+        self.checked = time.time()
+
+        if self.times is not None and \
+           self.getTimes(self.times.keys()) == self.times:
+            return
+
+        scfile, defs, excfile = self.key
+
+        S, self.error = SCA(dict(defs), self.opts.encoding), None
+
+        try:
+            S.readFromFile(scfile)
+            if excfile is not None: S.loadExceptions(excfile)
+            if self.opts.optimise: S.optimise()
+        except SCAException, e:
+            self.sca, self.error = None, e.s
+        except IOError, e:
+            self.sca, self.error = None, "Can't read '%s'" % e.filename
+
+        if self.error is not None:
+            self.times = self.getTimes(S.sources or [ scfile ])
+            return
+
+        if self.opts.cache: S.setCache(self.opts.cache)
+
+        self.sca, self.times = S, self.getTimes(S.sources)
+        self.loads += 1
+
+    """ Return the results of processing _words_ in _dialects_, or in
+    all dialects if that's None.
+    """
+    def process(self, words, dialects = None):
+        self.lock.acquire()
+
+        try:
+            self.load()
+
+            if self.error is not None: raise SCAException(self.error)
+
+            S = self.sca
+            D = dialects or S.dialects
+
+            for d in D:
+                if d not in S.dialects:
+                    raise SCAException("Unknown dialect '%s'", d)
+
+            self.requests += 1
+            self.words += len(words)
+
+            return [ S.process(word, D) for word in words ]
+        finally:
+            self.lock.release()
+
+    """ Return what has been done with these rules, for a stats request.
+    """
+    def getStats(self):
+        scfile, defs, excfile = self.key
+
+        H = { "rules": scfile, "defs": dict(defs), "exceptions": excfile,
+              "loads": self.loads, "requests": self.requests,
+              "words": self.words, "error": self.error }
+
+        if self.sca is not None and self.sca.cache is not None:
+            H["hits"]   = self.sca.cache.hits
+            H["misses"] = self.sca.cache.misses
+
+        return H
+
+##############################################################################
+
+""" The rules loaded in the server, and what it has done. """
+
+class SCAServerState:
+    """ The constructor.
+    opts: the server's options
+    """
+    def __init__(self, opts):
+        self.opts, self.rules = opts, {}
+        self.started, self.requests, self.errors = time.time(), 0, 0
+        self.lock = threading.Lock()
+
+    """ Return the SCAServerRules for the rules, variables, and
+    exceptions in request _H_, adding it if it's new.
+    """
+    def getRules(self, H):
+        scfile = H["rules"]
+
+        if scfile[-4:] != '.sca': scfile += '.sca'
+
+        excfile = H.get("exceptions")
+        if excfile is not None: excfile = os.path.abspath(excfile)
+
+        defs = H.get("defs") or {}
+        key  = (os.path.abspath(scfile), tuple(sorted(defs.items())),
+                excfile)
+
+        self.lock.acquire()
+
+        try:
+            if key not in self.rules:
+                self.rules[key] = SCAServerRules(key, self.opts)
+
+            return self.rules[key]
+        finally:
+            self.lock.release()
+
+    """ Return the response to request _H_. """
+    def respond(self, H):
+        self.requests += 1
+
+        try:
+            if H.get("stats"): return self.getStats()
+
+            if "rules" not in H or "words" not in H:
+                raise SCAException("Requests need 'rules' and 'words'")
+
+            R = self.getRules(H)
+
+            return { "results": R.process(H["words"], H.get("dialects")) }
+        except SCAException, e:
+            self.errors += 1
+            return { "error": e.s }
+        except Exception, e:
+            # Such as a word which isn't a string.
+            self.errors += 1
+            return { "error": "%s: %s" % (type(e).__name__, e) }
+
+    """ Return what the server has done so far. """
+    def getStats(self):
+        return { "uptime":   time.time() - self.started,
+                 "requests": self.requests,
+                 "errors":   self.errors,
+                 "rules":    [ R.getStats() for R in self.rules.values() ] }
+
+##############################################################################
+
+""" Handle one connection to the server, which may send any number of
+requests, one to a line.
+"""
+
+class SCARequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        state = self.server.state
+
+        for line in self.rfile:
+            if line.strip() == "": continue
+
+            try:
+                H = json.loads(line)
+            except ValueError:
+                H = None
+
+            if isinstance(H, dict): R = state.respond(H)
+            else: R = { "error": "Requests must be JSON objects" }
+
+            self.wfile.write(json.dumps(R) + "\n")
+            self.wfile.flush()
+
+class SCAUnixServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class SCATCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads, allow_reuse_address = True, True
+
+##############################################################################
+
+""" Start the server with the command-line options in _args_ and run
+it until it's interrupted.
+"""
+
+def main(args):
+    OP = optparse.OptionParser()
+
+    OP.add_option("-u", "--socket", dest = "socket",
+                  help = "Unix socket to listen on")
+    OP.add_option("-p", "--port", dest = "port", type = "int",
+                  help = "port to listen on, on this machine only")
+    OP.add_option("-e", "--encoding", dest = "encoding", default = "utf-8",
+                  help = "the encoding of the rules")
+    OP.add_option("-O", "--optimise", dest = "optimise",
+                  action = "store_true", default = False,
+                  help = "replace rules with faster equivalents")
+    OP.add_option("-k", "--cache", dest = "cache", type = "int",
+                  default = 10000,
+                  help = "number of results to keep for each set of rules")
+    OP.add_option("-i", "--interval", dest = "interval", type = "float",
+                  default = 1.0,
+                  help = "seconds between checks for changed rules")
+
+    opts, args = OP.parse_args(args)
+
+    if (opts.socket is None) == (opts.port is None):
+        raise SCAException("Give one of '-u' and '-p'")
+
+    if opts.socket is not None:
+        if os.path.exists(opts.socket): os.remove(opts.socket)
+        server = SCAUnixServer(opts.socket, SCARequestHandler)
+    else:
+        server = SCATCPServer(("127.0.0.1", opts.port), SCARequestHandler)
+
+    server.state = SCAServerState(opts)
+
+    # Tidy up when killed, as when interrupted.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if opts.socket is not None: os.remove(opts.socket)
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except SCAException, e:
+        print e.s
+
+##############################################################################
@@ -5,9 +5,11 @@
 # This is a test program for the SCA class. It uses SCAtest.yaml for
 # its definitions.
 
-import yaml, sys, traceback
+import yaml, sys, traceback, codecs, json, os, shutil, socket, subprocess
+import tempfile, time
 
 from SCA import *
+from SCAcache import SCACache
 
 debug, verbose, colour, tests = False, False, True, []
 
@@ -59,8 +61,17 @@ try:
         S.activegroup.addRule(R)
         rules += 1
 
+        # Rules with percentages need the same random numbers each time.
+        if "seed" in H: S.dir_seed(H["seed"])
+
+        E, d = None, H.get("dialect", '')
+
+        if "exceptions" in H:
+            E = SCAExceptionWords()
+            E.readFromFile(H["exceptions"], "utf-8")
+
         for old, new in H["test"]:
-            ret, t = R.apply('', old, None, debug)
+            ret, t = R.apply(d, old, E, debug)
 
             if verbose:
                 print "  %s -> %d %s: " % (cols(old, 33), ret, cols(new, 36)),
@@ -90,6 +101,340 @@ except Exception, e:
     print cols("%s" % H["rule"], 41)
     traceback.print_exc()
 
+##############################################################################
+
+# Whole sound-change files, each of which is processed in ways which
+# must give the same results; see "files" in SCAtest.yaml.
+
+tmpdir = tempfile.mkdtemp()
+
+""" Return the sound-change file for test _H_, writing it from its
+text if it has no file of its own.
+"""
+
+def getFile(H):
+    if "file" in H: return os.path.abspath(H["file"])
+
+    f = os.path.join(tmpdir, H["name"].replace(" ", "_") + ".sca")
+
+    if not os.path.exists(f):
+        F = codecs.open(f, "w", "utf-8")
+        F.write(H["text"])
+        F.close()
+
+    return f
+
+""" Return a new SCA instance with the rules for test _H_, with its
+_strings_ defined first; these may hold what a file can't. Optimise the
+rules if _optimise_ is true, as '-O' does.
+"""
+
+def build(H, optimise = False):
+    S = SCA()
+
+    for name, value in sorted(H.get("strings", {}).items()):
+        S.addDef("string", name, value)
+
+    S.readFromFile(getFile(H))
+    if optimise: S.optimise()
+
+    return S
+
+""" Return the words of test _H_, as unicode like those read from a
+file.
+"""
+
+def getWords(H): return [ unicode(w) for w in H["words"] ]
+
+""" Return what SCApply.py writes for the words of test _H_ with the
+extra options in _args_, as a list of lines.
+"""
+
+def runApply(H, *args):
+    lexfile = os.path.join(tmpdir, "words.txt")
+    outfile = os.path.join(tmpdir, "output.txt")
+
+    F = codecs.open(lexfile, "w", "utf-8")
+    for word in H["words"]: F.write(word + "\n")
+    F.close()
+
+    L = [ sys.executable, "SCApply.py", "-q", "-c", getFile(H),
+          "-l", lexfile, "-o", outfile ] + list(args)
+
+    P = subprocess.Popen(L, stdout = subprocess.PIPE,
+                         stderr = subprocess.STDOUT)
+    s = P.communicate()[0]
+
+    if P.returncode != 0: raise SCAException("SCApply.py failed:\n%s", s)
+
+    F = codecs.open(outfile, "r", "utf-8")
+    L = F.read().split("\n")
+    F.close()
+
+    return L
+
+""" Return tuples of what to compare for each line of output for test
+_H_: the word, the output without '-b', and the output when the rules
+have been saved with '-b' and when they've been loaded.
+"""
+
+def checkCompiled(H):
+    f = os.path.join(tmpdir, "compiled.bin")
+    if os.path.exists(f): os.remove(f)
+
+    A = runApply(H)
+    B = runApply(H, "-b", f)
+    C = runApply(H, "-b", f)
+
+    return [ (w, a, b) for w, a, b in zip(H["words"], A, B) ] + \
+           [ (w, a, c) for w, a, c in zip(H["words"], A, C) ]
+
+""" Return tuples of what to compare for each word of test _H_: the
+word, what SCA.process() gives in each dialect, and what
+SCA.process_many() gives, with its own batches and with batches of
+three words. Each comes from rules of its own, so that they start with
+the same random numbers.
+"""
+
+def checkMany(H):
+    words = getWords(H)
+
+    S = build(H)
+    A = [ tuple([ R[d] for d in S.dialects ])
+          for R in [ S.process(w) for w in words ] ]
+    B = list(build(H).process_many(words))
+    C = list(build(H).process_many(words, size = 3))
+
+    return zip(words, A, B) + zip(words, A, C)
+
+""" Return tuples of what to compare for each word in the _results_ of
+test _H_: the word, the results given for it in each dialect, and what
+SCA.process() and SCA.process_many() give.
+"""
+
+def checkResults(H):
+    words = [ unicode(T[0]) for T in H["results"] ]
+    E = [ tuple(T[1:]) for T in H["results"] ]
+
+    S = build(H)
+    A = [ tuple([ R[d] for d in S.dialects ])
+          for R in [ S.process(w) for w in words ] ]
+    B = list(build(H).process_many(words))
+
+    return zip(words, E, A) + zip(words, E, B)
+
+""" Return tuples of what to compare for each word of test _H_: the
+word, and what SCA.process() gives in each dialect with and without
+optimising the rules. If the test gives the kinds of rules it should be
+_optimised_ to, compare those too.
+"""
+
+def checkOptimise(H):
+    words = getWords(H)
+
+    A = [ build(H).process(w) for w in words ]
+    S = build(H, True)
+    B = [ S.process(w) for w in words ]
+
+    L = zip(words, A, B)
+
+    if "optimised" in H:
+        L.append(("kinds", H["optimised"],
+                  [ R.kind for R in S.main.rules ]))
+
+    return L
+
+""" Return tuples of what to compare for each line of output for test
+_H_: the word, and the output with '-j 1' and with '-j 2'. The words
+are repeated so that they're sent to the workers in several chunks. If
+the test says whether the words can be _split_ between processes, or
+have to fall back to one, compare that too.
+"""
+
+def checkJobs(H):
+    import SCAjobs
+
+    H = dict(H, words = H["words"] * (1200 // len(H["words"]) + 1))
+
+    A = runApply(H, "-j", "1")
+    B = runApply(H, "-j", "2")
+
+    L = zip(H["words"], A, B)
+    L.append(("lines", len(A), len(B)))
+
+    if "split" in H:
+        L.append(("split", H["split"], SCAjobs.canSplit(build(H))))
+
+    return L
+
+""" Return tuples of what to compare for each word of test _H_: the
+word, what SCA.process() gives without a cache, and what it gives with
+one. The cache is shared with the rules read with other definitions
+(_defs_), with exceptions (_exceptions_), in one dialect at a time, and
+from the same file with other contents (_changed_), none of which may
+be given the others' results. Rules which can't be cached mustn't use
+it at all, and those which can must find every word in it the second
+time round.
+"""
+
+def checkCache(H):
+    words, C, L = getWords(H), SCACache(), []
+    f = os.path.join(tmpdir, "cache.sca")
+
+    def make(text, defs, exceptions):
+        F = codecs.open(f, "w", "utf-8")
+        F.write(text)
+        F.close()
+
+        S = SCA(defs)
+        S.readFromFile(f)
+        if exceptions is not None: S.loadExceptions(exceptions)
+
+        return S
+
+    for text in H["text"], H.get("changed", H["text"]):
+        for defs in {}, H.get("defs", {}):
+            for exceptions in None, H.get("exceptions"):
+                args = text, defs, exceptions
+                D = make(*args).dialects
+
+                for d in [ D ] + list(D):
+                    S = make(*args)
+                    A = [ S.process(w, d) for w in words ]
+
+                    S = make(*args)
+                    S.cache = C
+                    n = len(C.H), C.hits, C.misses
+
+                    L += zip(words, A, [ S.process(w, d) for w in words ])
+
+                    if not S.isCacheable():
+                        L.append(("uncached", n,
+                                  (len(C.H), C.hits, C.misses)))
+                        continue
+
+                    n = C.hits
+                    L += zip(words, A, [ S.process(w, d) for w in words ])
+                    L.append(("hits", n + len(words), C.hits))
+
+    return L
+
+""" Send each of the requests in _L_ to the server listening on socket
+_f_, and return its responses.
+"""
+
+def ask(f, *L):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(f)
+    F = s.makefile("rwb")
+
+    R = []
+
+    for H in L:
+        F.write(json.dumps(H) + "\n")
+        F.flush()
+        R.append(json.loads(F.readline()))
+
+    # Wait for the server to finish with the connection, so that it can
+    # be stopped cleanly.
+    s.shutdown(socket.SHUT_WR)
+    F.read()
+    F.close()
+    s.close()
+
+    return R
+
+""" Return tuples of what to compare for test _H_ when its words are
+sent to SCAserver.py: a name for each comparison, what's expected, and
+what the server gave. Another set of rules in the server, which is
+read again after it changes, mustn't change the results.
+"""
+
+def checkServer(H):
+    f, other = os.path.join(tmpdir, "server"), os.path.join(tmpdir, "other")
+
+    def write(s):
+        F = open(other + ".sca", "w")
+        F.write("!dialects AB\n!seed value=7\n" + s + "\n")
+        F.close()
+
+    write("* o u _")
+
+    S = SCA()
+    S.readFromFile(getFile(H))
+
+    P = subprocess.Popen([ sys.executable, "SCAserver.py", "-u", f,
+                           "-i", "0" ])
+
+    try:
+        for n in range(100):
+            if os.path.exists(f): break
+            time.sleep(0.1)
+
+        words = H["words"]
+        batch = { "rules": getFile(H), "words": words }
+
+        A, B, C = ask(f, batch, { "rules": other, "words": [ "po" ] },
+                      { "rules": other, "words": [ "po" ], "dialects": "Z" })
+
+        # The other rules change, and are read again.
+        write("* o y _")
+        t = time.time() + 10
+        os.utime(other + ".sca", (t, t))
+
+        D, E, F = ask(f, { "rules": other, "words": [ "po" ] }, batch,
+                      { "stats": True })
+    finally:
+        P.terminate()
+        P.wait()
+
+    L = [ ("batch", [ S.process(w) for w in words ], A.get("results")),
+          ("batch again", [ S.process(w) for w in words ],
+           E.get("results")),
+          ("other", [ { "A": "pu", "B": "pu" } ], B.get("results")),
+          ("unknown dialect", "Unknown dialect 'Z'", C.get("error")),
+          ("changed", [ { "A": "py", "B": "py" } ], D.get("results")) ]
+
+    R = dict([ (R["rules"], R) for R in F["rules"] ])
+
+    L.append(("requests", 6, F.get("requests")))
+    L.append(("loads", 2, R[other + ".sca"]["loads"]))
+    L.append(("words", 2 * len(words), R[getFile(H)]["words"]))
+
+    return L
+
+checks = { "compiled": checkCompiled, "server": checkServer,
+           "many": checkMany, "results": checkResults,
+           "optimise": checkOptimise, "cache": checkCache,
+           "jobs": checkJobs }
+
+if len(tests) == 0:
+    try:
+        for i, H in enumerate(Y["files"]):
+            name = H["name"]
+
+            if verbose: print cols("=" * 20 + " " + name, 37)
+
+            for check in H["checks"]:
+                for word, old, new in checks[check](H):
+                    if old == new:
+                        good += 1
+                    else:
+                        L.append((i, name, word, old, new, check))
+                        bad += 1
+
+        print cols(cols("%d files tested" % len(Y["files"]), 37), 44)
+    except SCAException, e:
+        print cols(cols("Caught an SCA exception in file '%s'!" % name,
+                        33), 41)
+        print cols(cols(e.s, 33), 41)
+        traceback.print_exc()
+    except Exception, e:
+        print cols(cols("Caught an exception in file '%s'!" % name, 37), 41)
+        traceback.print_exc()
+
+shutil.rmtree(tmpdir)
+
 print "%s good, %s bad" % (cols(good, 32), cols(bad, 31))
 
 if not verbose:
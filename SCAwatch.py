@@ -0,0 +1,218 @@
+# This file is part of Geoff's Sound Change Applier, version 0.8
+# (August 2010). You can obtain the latest version of this program
+# from http://gesc19764.pwp.blueyonder.co.uk/sca.html
+
+""" Watching the files a set of rules was read from, and processing a
+lexicon through them again whenever any of them changes.
+
+The main group is divided into stages at each heading and group in
+it, and what each word had become at the start of each stage is kept.
+When the rules are read again, every stage up to the first one with
+anything changed before its end does the same as it did, so processing
+starts again from what was kept for the start of that stage. An edit
+near the end of a long file means that only the last few stages are
+run again.
+
+Whether a stage has changed comes from SCA.marks, a digest of all the
+lines compiled before each heading and group, including those of
+definitions. Persistent rules and exceptions apply to every stage, so
+if any of them change, or if results depend on more than the word (see
+SCA.isCacheable()), everything is run again.
+"""
+
+from SCA import *
+
+import collections, os, time
+
+##############################################################################
+
+class SCAWatcher:
+    """ The constructor.
+    build: a function which returns a new SCA instance with the rules
+    as they are now
+    words: the words to process
+    dialects: the dialects to process them in, or None for those
+    declared by the rules
+    """
+    def __init__(self, build, words, dialects = None):
+        self.build, self.dialects = build, dialects
+        self.words = list(collections.OrderedDict.fromkeys(words))
+
+        # What each word became in each dialect, and what it was at the
+        # start of each stage; see run().
+        self.results, self.stages = {}, {}
+
+        self.sca, self.key, self.marks, self.times = None, None, [], {}
+
+        # How long the last update() took, in seconds.
+        self.elapsed = 0.0
+
+    ######################################################################
+
+    """ Return the modification times of the files the rules in _S_
+    were read from, or None for any which can't be found.
+    """
+    def getTimes(self, S):
+        T = {}
+
+        for f in S.sources:
+            try:
+                T[f] = os.path.getmtime(f)
+            except OSError:
+                T[f] = None
+
+        return T
+
+    """ Have any of the files the rules were read from changed since
+    they were last read?
+    """
+    def changed(self): return self.getTimes(self.sca) != self.times
+
+    """ Return the headings and groups in _S_'s main group at which
+    stages start, with the digest for each; the first stage starts at
+    the beginning, with None, and always has the same digest.
+    """
+    def getMarks(self, S):
+        L = [ (None, "") ]
+
+        for R, h in S.marks:
+            if not isinstance(R, SCARule): L.append((R, h))
+
+        return L
+
+    """ Return what has to be the same in _S_ as in the last rules for
+    any of their results to be kept, or None if nothing can be kept.
+    """
+    def getKey(self, S):
+        if not S.isCacheable() or S.persistent.hasRandomParams():
+            return None
+
+        P = [ h for R, h in S.marks if isinstance(R, SCARule) ]
+
+        return (self.dialects or S.dialects, P,
+                S.exceptions.digest.hexdigest())
+
+    """ Return the index of the stage from which the new rules _S_ have
+    to be run; everything before it does the same as the last rules.
+    """
+    def getStart(self, S):
+        key = self.getKey(S)
+
+        if self.sca is None or key is None or key != self.key: return 0
+
+        n, L = 0, self.getMarks(S)
+
+        for i in range(min(len(L), len(self.marks))):
+            if L[i][1] != self.marks[i][1]: break
+            n = i
+
+        return n
+
+    ######################################################################
+
+    """ Read the rules again, and run every word through the stages
+    which may have changed. The return value is a tuple of the stage
+    they were run from, with its heading or group, or None for the
+    first, and a list of the words whose results changed, with what
+    they were before and are now.
+    """
+    def update(self):
+        t = time.time()
+
+        # Files may be changed while they're read, so the times are
+        # those from before.
+        if self.sca is not None: self.times = self.getTimes(self.sca)
+
+        S = self.build()
+
+        if self.sca is None: self.times = self.getTimes(S)
+
+        n, L = self.getStart(S), self.getMarks(S)
+
+        # Where in the main group each stage starts.
+        index = dict([ (id(R), i) for i, R in enumerate(S.main.rules) ])
+        starts = [ 0 ] + [ index[id(R)] for R, h in L[1:] ]
+        starts.append(len(S.main.rules))
+
+        changes = []
+
+        for word in self.words:
+            old = self.results.get(word)
+            H = self.run(S, word, starts, n)
+
+            if H != old: changes.append((word, old, H))
+
+        self.sca, self.key, self.marks = S, self.getKey(S), L
+        self.elapsed = time.time() - t
+
+        return n, L[n][0], changes
+
+    """ Run _word_ through _S_ from stage _n_, which starts at the
+    rule in _starts_[_n_] of the main group, keeping what it is at the
+    start of each stage after that. The main group has no parameters,
+    so this does the same as SCA.process(), apart from the cache.
+    """
+    def run(self, S, word, starts, n):
+        if n == 0:
+            H = dict([ (d, word) for d in self.dialects or S.dialects ])
+            self.stages[word] = []
+        else:
+            H = dict(self.stages[word][n])
+
+        del self.stages[word][n:]
+
+        S.setLastWord(word)
+        S.persistent.fixed.clear()
+
+        E, P = S.exceptions, S.persistent
+
+        for i in range(n, len(starts) - 1):
+            self.stages[word].append(dict(H))
+
+            for R in S.main.rules[starts[i]:starts[i + 1]]:
+                R.process(H, E, P)
+                P.settle(H, E)
+
+        self.results[word] = H
+
+        return dict(H)
+
+    """ Return the results for _word_ from the last update(); this and
+    process_many() are so that an SCAWatcher can stand in for an SCA
+    instance when the results are written out.
+    """
+    def process(self, word, dialects = None, **extras):
+        return dict(self.results[word])
+
+    """ Return the results for _words_ in _dialects_ from the last
+    update(), as SCA.process_many() does.
+    """
+    def process_many(self, words, dialects, columns = False):
+        T = [ tuple([ self.results[w][d] for d in dialects ]) for w in words ]
+
+        if not columns: return iter(T)
+
+        return dict([ (d, [ t[i] for t in T ])
+                      for i, d in enumerate(dialects) ])
+
+    """ Call update() whenever the files the rules were read from
+    change, checking every _interval_ seconds, until interrupted, and
+    call _report_ with what it returned. If the rules can't be read,
+    _complain_ is called with the SCAException instead, and the last
+    rules are kept.
+    """
+    def watch(self, report, complain, interval = 1.0):
+        try:
+            while True:
+                time.sleep(interval)
+
+                if not self.changed(): continue
+
+                try:
+                    report(*self.update())
+                except SCAException, e:
+                    complain(e)
+        except KeyboardInterrupt:
+            pass
+
+##############################################################################